@@ -1,95 +1,2071 @@
+import time
+STARTED = time.perf_counter()
 import os
 import re
+import sys
 import json
+import gzip
+import math
+import hashlib
 import shutil
+import argparse
+import tempfile
+import threading
+import queue
+import select
+import struct
+import ctypes
+import ctypes.util
+import statistics
+import cProfile
+import pstats
+import heapq
+import fnmatch
+import importlib.util
 import tkinter as tk
 import sirilpy as s
-s.ensure_installed("ttkthemes", "astropy.io", "sqlite3")
+
+def ensure_dependencies(packages=("ttkthemes", "astropy.io", "sqlite3"), force=False):
+    # ensure_installed queries pip on every call, so a successful check is remembered per
+    # interpreter and sirilpy version and skipped on later starts, as long as the packages
+    # can still be found. force=True checks again after an import failed anyway.
+    marker = os.path.expanduser("~/.siril-dark-libraries/dependencies.json")
+    key = {"python": os.path.realpath(sys.executable), "sirilpy": getattr(s, "__version__", None),
+           "packages": list(packages)}
+    try:
+        with open(marker, 'r') as f:
+            if (not force and json.load(f) == key
+                    and all(importlib.util.find_spec(p.split(".")[0]) for p in packages)):
+                return
+    except (OSError, ValueError):
+        pass
+    s.ensure_installed(*packages)
+    os.makedirs(os.path.dirname(marker), exist_ok=True)
+    with open(marker, 'w') as f:
+        json.dump(key, f)
+
+ensure_dependencies()
 
 import sqlite3
 from tkinter import ttk, filedialog, messagebox
-from ttkthemes import ThemedTk
-from astropy.io import fits
+import numpy as np
 from datetime import datetime
+from collections import deque, namedtuple
+from contextlib import closing, contextmanager, nullcontext
+from functools import lru_cache
+from itertools import accumulate
+from bisect import bisect_left, bisect_right
+from urllib.request import pathname2url
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 LIBRARIES_CONFIG = os.path.expanduser("~/.siril-dark-libraries.json")
 DB_DIR = os.path.expanduser("~/.siril-dark-libraries")
 os.makedirs(DB_DIR, exist_ok=True)
+# All libraries share one catalog database. LIBRARIES_CONFIG and the per-library
+# databases it points to are imported into it once and then left alone.
+CATALOG_DB = os.path.join(DB_DIR, "catalog.sqlite")
+# Library dropdown entry that selects darks from every library at once.
+ALL_LIBRARIES = "(all libraries)"
+QUEUE_FILE = os.path.join(DB_DIR, "queue.json")
+# Every scan, rescan and master creation appends its phase timings to TIMINGS_LOG.
+# Set DARK_O_MAT_PROFILE=1 to also dump a cProfile of each operation into PROFILE_DIR.
+TIMINGS_LOG = os.path.join(DB_DIR, "timings.jsonl")
+PROFILE_DIR = os.path.join(DB_DIR, "profiles")
+PROFILE_ENABLED = os.environ.get("DARK_O_MAT_PROFILE") == "1"
+# Files slower than this are listed individually, at most OUTLIERS_KEPT of them.
+OUTLIER_SECONDS = 0.5
+OUTLIERS_KEPT = 20
+
+# Header ingestion is I/O bound (NAS, USB disks), so threads are the default.
+# Switch to processes only if header parsing itself becomes the bottleneck.
+INGEST_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+INGEST_USE_PROCESSES = False
+
+# Per-frame statistics (mean, median, robust sigma, hot pixels) computed during ingestion
+# on every FRAME_STATS_STRIDE-th row and column, and used to rank frames for stacking.
+INGEST_FRAME_STATS = True
+FRAME_STATS_STRIDE = 8
+HOT_PIXEL_SIGMA = 5.0
+
+# Library scans list directories on SCAN_WORKERS threads at once, which hides the
+# per-directory latency of network shares. Files and directories whose name matches an
+# SCAN_EXCLUDE glob are skipped (by default staging directories, including the fixed
+# master_dark_tmp of older versions, and generated masters), files must also match one
+# of the SCAN_INCLUDE globs.
+SCAN_WORKERS = 16
+SCAN_INCLUDE = ("*",)
+SCAN_EXCLUDE = ("master_dark_tmp", "master_dark_tmp_*", "master-dark_*")
+
+# Every indexed dark gets a content hash so copies of one frame in several folders or
+# libraries are recognised and never stacked together. The hash covers the file size and
+# CONTENT_HASH_SAMPLES chunks of CONTENT_HASH_CHUNK bytes spread over the file (None
+# hashes whole files), and is cached per path, size and mtime.
+CONTENT_HASH_SAMPLES = 8
+CONTENT_HASH_CHUNK = 64 * 1024
+
+# Library indexes can be exported to a gzipped, column-wise JSON file and imported on
+# another machine under a different root. Imported entries whose size and mtime (within
+# IMPORT_MTIME_TOLERANCE_NS, for filesystems with coarse timestamps) match the local file
+# are taken over as they are, all others are read again.
+INDEX_FORMAT = 1
+IMPORT_MTIME_TOLERANCE_NS = 2 * 10 ** 9
+
+# Rows are written with executemany in batches of this size, one transaction per batch.
+INSERT_BATCH_SIZE = 500
+
+# "auto" hardlinks darks into the staging directory when it shares a filesystem with
+# the source, symlinks them otherwise and only copies when neither is possible.
+# "copy" always copies.
+STAGING_MODE = "auto"
+
+# Parameters of the Siril stack command; part of the master cache key.
+STACK_PARAMS = ("rej", "3", "3")
+
+# "siril" stacks with the connected Siril, "numpy" with the built-in sigma-clipping
+# engine, "auto" uses Siril when the connection succeeded and numpy otherwise.
+STACK_BACKEND = "auto"
+# The numpy engine loads one band of rows from every frame at a time, one band per
+# worker. Bands are sized so that all of them together, clipping temporaries included,
+# stay within this many bytes, whatever the frame count.
+LOCAL_STACK_TILE_BYTES = 64 * 1024 ** 2
+LOCAL_STACK_WORKERS = min(8, os.cpu_count() or 1)
+# Peak memory of clipping one band in multiples of its float32 cube: the cube itself plus
+# about 8 cubes of masks and NaN-filled copies (measured with tracemalloc).
+LOCAL_STACK_CLIP_FACTOR = 10
+
+# Generated masters are reused while their input frames are unchanged. The least
+# recently used ones are deleted once the cached masters exceed these limits
+# (None disables a limit).
+MASTER_CACHE_MAX_BYTES = 20 * 1024 ** 3
+MASTER_CACHE_MAX_ENTRIES = None
+
+# The temperature dropdowns list readings rounded to TEMP_BUCKET degrees C. A single
+# temperature selects the darks within the chosen tolerance, closest first.
+TEMP_BUCKET = 1.0
+TEMP_TOLERANCES = (0.5, 1.0, 2.0, 5.0)
+
+# Batch mode groups darks into temperature buckets of this width (degrees C).
+BATCH_TEMP_BUCKET = 1.0
+BATCH_JOBS = 2
+
+# Watch mode keeps the index of the selected library current while darks are written.
+# "auto" uses inotify on local Linux filesystems and polls every WATCH_POLL_SECONDS on
+# network shares and elsewhere; "inotify" and "poll" force one of them. A new or changed
+# file is indexed once it saw no event for WATCH_DEBOUNCE_SECONDS and its mtime is at
+# least WATCH_SETTLE_SECONDS old, so files still being written are not read half-way.
+WATCH_MODE = "auto"
+WATCH_POLL_SECONDS = 30.0
+WATCH_DEBOUNCE_SECONDS = 1.0
+WATCH_SETTLE_SECONDS = 3.0
+NETWORK_FILESYSTEMS = ("nfs", "nfs4", "cifs", "smb3", "smbfs", "fuse.sshfs", "9p", "afs")
+
+# Bump together with a new step in migrate_db.
+SCHEMA_VERSION = 7
+
+# Minimum seconds between two progress reports of a background operation.
+PROGRESS_INTERVAL = 0.2
+
+FITS_BLOCK_SIZE = 2880
+FITS_CARD_SIZE = 80
+# Tile-compressed (.fz) and gzipped (.gz) darks are indexed from their headers alone and
+# unpacked to plain FITS only when they are staged for stacking.
+FITS_EXTENSIONS = (".fit", ".fits", ".fts", ".fit.fz", ".fits.fz", ".fts.fz", ".fit.gz", ".fits.gz", ".fts.gz")
 
 siril = s.SirilInterface()
-print("Loading " + LIBRARIES_CONFIG)
+# Siril runs one command at a time and "cd" changes its global state, so every
+# cd/convert/stack sequence holds this lock.
+SIRIL_LOCK = threading.Lock()
+# None until connect_siril() ran. The window connects in the background right after it
+# appears, batch mode on the first job that needs Siril.
+SIRIL_CONNECTED = None
+SIRIL_CONNECT_LOCK = threading.Lock()
+# Since Python 3.12 cProfile hooks into sys.monitoring: an enabled profiler sees every
+# thread and only one can be enabled per process. operation_profile.profiled() then
+# shares the enabled profiler between the threads of its operation with a use count.
+PROFILE_PROCESS_WIDE = sys.version_info >= (3, 12)
+PROFILE_LOCK = threading.Lock()
+ACTIVE_PROFILER = None
+ACTIVE_PROFILER_USERS = 0
+print("Loading " + CATALOG_DB)
 
-try:
-    siril.connect()
-    print("Successfully connected to Siril!")
-except SirilConnectionError as e:
-    print(f"Connection to Siril failed: {e}")
+def connect_siril():
+    global SIRIL_CONNECTED
+    with SIRIL_CONNECT_LOCK:
+        if SIRIL_CONNECTED is None:
+            try:
+                siril.connect()
+                SIRIL_CONNECTED = True
+                print("Successfully connected to Siril!")
+            except s.SirilConnectionError as e:
+                SIRIL_CONNECTED = False
+                print(f"Connection to Siril failed: {e}")
+    return SIRIL_CONNECTED
 
-def load_libraries():
+@lru_cache(maxsize=None)
+def astropy_fits():
+    # astropy takes seconds to import and is only needed by the numpy stacking engine.
+    from astropy.io import fits
+    return fits
+
+def connect_db(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    migrate_db(conn)
+    return conn
+
+@contextmanager
+def transaction(conn):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+def migrate_db(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return
+    with transaction(conn):
+        c = conn.cursor()
+        if version < 1:
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS darks (
+                    id INTEGER PRIMARY KEY,
+                    path TEXT,
+                    ccd_temp REAL,
+                    iso INTEGER,
+                    gain REAL,
+                    exptime REAL,
+                    naxis1 INTEGER,
+                    naxis2 INTEGER,
+                    xbinning INTEGER,
+                    ybinning INTEGER,
+                    size INTEGER,
+                    mtime_ns INTEGER,
+                    inode INTEGER
+                )
+            """)
+            # Libraries created before fingerprinting lack these columns; their rows
+            # keep NULL fingerprints and are simply re-read on the next rescan.
+            columns = {row[1] for row in c.execute("PRAGMA table_info(darks)")}
+            for col in ("size", "mtime_ns", "inode"):
+                if col not in columns:
+                    c.execute(f"ALTER TABLE darks ADD COLUMN {col} INTEGER")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_darks_path ON darks (path)")
+            c.execute("""
+                CREATE INDEX IF NOT EXISTS idx_darks_criteria
+                ON darks (iso, exptime, naxis1, naxis2, xbinning, ybinning, ccd_temp)
+            """)
+            c.execute("CREATE INDEX IF NOT EXISTS idx_darks_ccd_temp ON darks (ccd_temp)")
+            # Files without usable dark metadata, remembered so rescans do not re-read them.
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS skipped_files (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER,
+                    mtime_ns INTEGER,
+                    inode INTEGER
+                )
+            """)
+        if version < 2:
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS masters (
+                    key TEXT PRIMARY KEY,
+                    path TEXT,
+                    frames INTEGER,
+                    size INTEGER,
+                    created REAL,
+                    last_used REAL
+                )
+            """)
+            c.execute("CREATE INDEX IF NOT EXISTS idx_masters_last_used ON masters (last_used)")
+        if version < 3:
+            columns = {row[1] for row in c.execute("PRAGMA table_info(darks)")}
+            for col, col_type in (("mean", "REAL"), ("median", "REAL"), ("sigma", "REAL"), ("hot_pixels", "INTEGER")):
+                if col not in columns:
+                    c.execute(f"ALTER TABLE darks ADD COLUMN {col} {col_type}")
+            # Forget the fingerprints of existing rows so the next rescan reads them again
+            # and fills in their statistics.
+            c.execute("UPDATE darks SET size = NULL WHERE median IS NULL")
+        if version < 4:
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS libraries (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT UNIQUE NOT NULL,
+                    path TEXT NOT NULL
+                )
+            """)
+            columns = {row[1] for row in c.execute("PRAGMA table_info(darks)")}
+            if "library_id" not in columns:
+                c.execute("ALTER TABLE darks ADD COLUMN library_id INTEGER")
+            c.execute("DROP INDEX IF EXISTS idx_darks_path")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_darks_library_path ON darks (library_id, path)")
+            # idx_darks_criteria serves queries across all libraries, this one queries
+            # restricted to some of them.
+            c.execute("""
+                CREATE INDEX IF NOT EXISTS idx_darks_library_criteria
+                ON darks (library_id, iso, exptime, naxis1, naxis2, xbinning, ybinning, ccd_temp)
+            """)
+            # The same file may be part of two libraries, so skipped files are kept per library.
+            c.execute("ALTER TABLE skipped_files RENAME TO skipped_files_v3")
+            c.execute("""
+                CREATE TABLE skipped_files (
+                    library_id INTEGER,
+                    path TEXT,
+                    size INTEGER,
+                    mtime_ns INTEGER,
+                    inode INTEGER,
+                    PRIMARY KEY (library_id, path)
+                )
+            """)
+            c.execute("INSERT INTO skipped_files (path, size, mtime_ns, inode) "
+                      "SELECT path, size, mtime_ns, inode FROM skipped_files_v3")
+            c.execute("DROP TABLE skipped_files_v3")
+        if version < 5:
+            columns = {row[1] for row in c.execute("PRAGMA table_info(darks)")}
+            if "content_hash" not in columns:
+                c.execute("ALTER TABLE darks ADD COLUMN content_hash TEXT")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_darks_content_hash ON darks (content_hash)")
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS file_hashes (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER,
+                    mtime_ns INTEGER,
+                    content_hash TEXT
+                )
+            """)
+            # As for the statistics, the next rescan re-reads rows without a hash.
+            c.execute("UPDATE darks SET size = NULL WHERE content_hash IS NULL")
+        if version < 6:
+            # Cameras without ISOSPEED are grouped by GAIN, so the criteria indexes key on
+            # the same COALESCE(iso, gain) expression the queries use.
+            c.execute("DROP INDEX IF EXISTS idx_darks_criteria")
+            c.execute("DROP INDEX IF EXISTS idx_darks_library_criteria")
+            c.execute("""
+                CREATE INDEX idx_darks_criteria
+                ON darks (COALESCE(iso, gain), exptime, naxis1, naxis2, xbinning, ybinning, ccd_temp)
+            """)
+            c.execute("""
+                CREATE INDEX idx_darks_library_criteria
+                ON darks (library_id, COALESCE(iso, gain), exptime, naxis1, naxis2, xbinning, ybinning, ccd_temp)
+            """)
+        if version < 7:
+            # Every copy of a frame except the first one indexed, with the path it duplicates.
+            c.execute("""
+                CREATE VIEW IF NOT EXISTS duplicate_darks AS
+                SELECT d.library_id, d.path, o.path AS duplicate_of
+                FROM darks d JOIN darks o ON o.id = (
+                    SELECT MIN(id) FROM darks WHERE content_hash = d.content_hash)
+                WHERE d.content_hash IS NOT NULL AND d.id <> o.id
+            """)
+        c.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+def connect_catalog():
+    conn = connect_db(CATALOG_DB)
     if os.path.exists(LIBRARIES_CONFIG):
+        import_legacy_libraries(conn)
+    return conn
+
+DARK_COLUMNS = ("library_id, path, ccd_temp, iso, gain, exptime, naxis1, naxis2, xbinning, ybinning, "
+                "size, mtime_ns, inode, mean, median, sigma, hot_pixels, content_hash")
+
+def import_legacy_libraries(conn):
+    # Moves the JSON registry and its one-database-per-library files into the catalog.
+    # The old databases are only read; the registry is renamed so this runs once. A
+    # library whose database cannot be read is still registered and filled by a rescan.
+    try:
         with open(LIBRARIES_CONFIG, 'r') as f:
-            return json.load(f)
-    return {}
+            legacy = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Could not read {LIBRARIES_CONFIG}: {e}")
+        return
+    for name, info in legacy.items():
+        library_id = add_library(conn, name, info["path"])
+        if not os.path.exists(info["db"]):
+            continue
+        try:
+            import_legacy_db(conn, library_id, info["db"])
+        except sqlite3.Error as e:
+            print(f"Could not import library '{name}' from {info['db']}: {e}. Use Rescan to index it.")
+            continue
+        print(f"Imported library '{name}' from {info['db']}")
+    os.replace(LIBRARIES_CONFIG, LIBRARIES_CONFIG + ".imported")
 
-def save_libraries(libraries):
-    with open(LIBRARIES_CONFIG, 'w') as f:
-        json.dump(libraries, f, indent=2)
+def legacy_rows(legacy, table, columns):
+    # Databases of older versions lack some columns, they are read as NULL.
+    present = {row[1] for row in legacy.execute(f"PRAGMA table_info({table})")}
+    if not present:
+        return []
+    select = ", ".join(col if col in present else "NULL" for col in columns)
+    return legacy.execute(f"SELECT {select} FROM {table}").fetchall()
 
-def create_db(db_path):
-    with sqlite3.connect(db_path) as conn:
-        c = conn.cursor()
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS darks (
-                id INTEGER PRIMARY KEY,
-                path TEXT,
-                ccd_temp REAL,
-                iso INTEGER,
-                gain REAL,
-                exptime REAL,
-                naxis1 INTEGER,
-                naxis2 INTEGER,
-                xbinning INTEGER,
-                ybinning INTEGER
-            )
-        """)
-        conn.commit()
-
-def scan_directory(dir_path):
-    fits_files = []
-    for root, _, files in os.walk(dir_path):
-        for f in files:
-            if f.lower().endswith((".fit", ".fits")):
-                fits_files.append(os.path.join(root, f))
-    return fits_files
-
-def read_fits_header(file):
+def import_legacy_db(conn, library_id, db_path):
+    uri = f"file:{pathname2url(os.path.abspath(db_path))}?mode=ro"
+    with closing(sqlite3.connect(uri, uri=True)) as legacy:
+        darks = legacy_rows(legacy, "darks", DARK_COLUMNS.split(", ")[1:])
+        skipped = legacy_rows(legacy, "skipped_files", ("path", "size", "mtime_ns", "inode"))
+        masters = legacy_rows(legacy, "masters", ("key", "path", "frames", "size", "created", "last_used"))
+    with transaction(conn):
+        conn.execute("DELETE FROM darks WHERE library_id = ?", (library_id,))
+        conn.executemany(INSERT_DARK_SQL, [(library_id,) + row for row in darks])
+        conn.executemany(INSERT_SKIPPED_SQL, [(library_id,) + row for row in skipped])
+        conn.executemany("INSERT OR IGNORE INTO masters (key, path, frames, size, created, last_used) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", masters)
+        # As in migrate_db: rows without statistics or content hash are read again on the next rescan.
+        conn.execute("UPDATE darks SET size = NULL WHERE library_id = ? AND (median IS NULL OR content_hash IS NULL)",
+                     (library_id,))
+
+def add_library(conn, name, path):
+    with transaction(conn):
+        conn.execute("INSERT OR IGNORE INTO libraries (name, path) VALUES (?, ?)", (name, path))
+        conn.execute("UPDATE libraries SET path = ? WHERE name = ?", (path, name))
+    return conn.execute("SELECT id FROM libraries WHERE name = ?", (name,)).fetchone()[0]
+
+def remove_library(conn, library_id):
+    with transaction(conn):
+        conn.execute("DELETE FROM darks WHERE library_id = ?", (library_id,))
+        conn.execute("DELETE FROM skipped_files WHERE library_id = ?", (library_id,))
+        conn.execute("DELETE FROM libraries WHERE id = ?", (library_id,))
+
+def load_libraries(conn=None):
+    if conn is None:
+        with closing(connect_catalog()) as conn:
+            return load_libraries(conn)
+    return {name: {"id": library_id, "path": path}
+            for library_id, name, path in conn.execute("SELECT id, name, path FROM libraries ORDER BY name")}
+
+@lru_cache(maxsize=None)
+def glob_matcher(patterns):
+    return re.compile("|".join(fnmatch.translate(p) for p in patterns) or "(?!)").match
+
+def list_directory(path, include, exclude, errors=None):
+    files, dirs = [], []
     try:
-        with fits.open(file) as hdul:
-            hdr = hdul[0].header
-            temp = hdr.get("CCD-TEMP")
-            iso = hdr.get("ISOSPEED")
-            gain = hdr.get("GAIN") or hdr.get("EGAIN")
-            exptime = hdr.get("EXPTIME")
-            naxis1 = hdr.get("NAXIS1")
-            naxis2 = hdr.get("NAXIS2")
-            xbin = hdr.get("XBINNING")
-            ybin = hdr.get("YBINNING")
-            if None in (temp, exptime, naxis1, naxis2, xbin, ybin) or (iso is None and gain is None):
-                return None
-            return {
-                "path": file,
-                "ccd_temp": temp,
-                "iso": iso,
-                "gain": gain,
-                "exptime": exptime,
-                "naxis1": naxis1,
-                "naxis2": naxis2,
-                "xbinning": xbin,
-                "ybinning": ybin
-            }
+        with os.scandir(path) as it:
+            for entry in it:
+                if exclude(entry.name):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    elif entry.name.lower().endswith(FITS_EXTENSIONS) and include(entry.name):
+                        files.append(entry.path)
+                except OSError:
+                    pass
+    except OSError as e:
+        print(f"Error scanning {path}: {e}")
+        if errors is not None:
+            errors.append(path)
+    return files, dirs
+
+def iter_fits_files(dir_path, include=SCAN_INCLUDE, exclude=SCAN_EXCLUDE, workers=SCAN_WORKERS, errors=None):
+    # Yields paths while the walk goes on: subdirectories are submitted to the pool as soon
+    # as their parent is listed, so consumers can read headers before the walk is done.
+    # The order of the paths is not deterministic. Directories that could not be listed
+    # are appended to errors, if given.
+    include, exclude = glob_matcher(tuple(include)), glob_matcher(tuple(exclude))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(list_directory, dir_path, include, exclude, errors)}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    files, dirs = future.result()
+                    pending.update(pool.submit(list_directory, d, include, exclude, errors) for d in dirs)
+                    yield from files
+        finally:
+            for future in pending:
+                future.cancel()
+
+def scan_directory(dir_path, include=SCAN_INCLUDE, exclude=SCAN_EXCLUDE):
+    return sorted(iter_fits_files(dir_path, include, exclude))
+
+def is_scanned_path(root, path, include=SCAN_INCLUDE, exclude=SCAN_EXCLUDE):
+    # The same rules as iter_fits_files, for a single path below root.
+    name = os.path.basename(path)
+    if not name.lower().endswith(FITS_EXTENSIONS) or not glob_matcher(tuple(include))(name):
+        return False
+    exclude = glob_matcher(tuple(exclude))
+    return not any(exclude(part) for part in os.path.relpath(path, root).split(os.sep))
+
+def parse_header_value(raw):
+    raw = raw.strip()
+    if raw.startswith("'"):
+        chars, i = [], 1
+        while i < len(raw):
+            if raw[i] == "'":
+                if raw[i + 1:i + 2] == "'":
+                    chars.append("'")
+                    i += 2
+                    continue
+                break
+            chars.append(raw[i])
+            i += 1
+        return "".join(chars).rstrip()
+    value = raw.split("/", 1)[0].strip()
+    if not value:
+        return None
+    if value in ("T", "F"):
+        return value == "T"
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value.replace("D", "E"))
+    except ValueError:
+        return value
+
+def read_header_blocks(f, first="SIMPLE"):
+    # Only the 2880-byte header blocks up to END are read, pixel data is never touched.
+    # Afterwards f is positioned at the start of the data.
+    header = {}
+    while True:
+        block = f.read(FITS_BLOCK_SIZE)
+        if len(block) < FITS_BLOCK_SIZE:
+            raise ValueError("truncated FITS header")
+        for i in range(0, FITS_BLOCK_SIZE, FITS_CARD_SIZE):
+            card = block[i:i + FITS_CARD_SIZE].decode("ascii", "replace")
+            key = card[:8].strip()
+            if not header and key != first:
+                raise ValueError("not a FITS file" if first == "SIMPLE" else "missing FITS extension")
+            if key == "END":
+                return header
+            if card[8:10] == "= " and key not in header:
+                header[key] = parse_header_value(card[10:])
+
+def read_primary_header(file):
+    with open_fits(file) as f:
+        return read_header_blocks(f)
+
+def open_fits(file):
+    # gzip decompresses as the file is read, so reading a header only inflates its prefix.
+    return gzip.open(file, "rb") if file.lower().endswith(".gz") else open(file, "rb")
+
+def fits_data_size(hdr):
+    naxis = hdr.get("NAXIS", 0)
+    if not naxis:
+        return 0
+    count = 1
+    for n in range(1, naxis + 1):
+        count *= hdr.get(f"NAXIS{n}", 0)
+    size = abs(hdr.get("BITPIX", 8)) // 8 * hdr.get("GCOUNT", 1) * (hdr.get("PCOUNT", 0) + count)
+    return -(-size // FITS_BLOCK_SIZE) * FITS_BLOCK_SIZE
+
+def read_image_header(f):
+    # Header of the first image HDU, merged over the primary header, and whether its pixels
+    # are stored uncompressed at f's position afterwards. Empty primaries (multi-extension
+    # and .fz files) and table extensions are skipped without reading their data; a
+    # tile-compressed image reports the dimensions of the image, not of its table.
+    primary = hdr = read_header_blocks(f)
+    while True:
+        ext = hdr.get("XTENSION") if hdr is not primary else None
+        if ext == "BINTABLE" and hdr.get("ZIMAGE"):
+            image = dict(hdr, BITPIX=hdr["ZBITPIX"], NAXIS=hdr["ZNAXIS"])
+            for n in range(1, hdr["ZNAXIS"] + 1):
+                image[f"NAXIS{n}"] = hdr[f"ZNAXIS{n}"]
+            return image, False
+        if ext in (None, "IMAGE") and hdr.get("NAXIS", 0) > 0:
+            return hdr, True
+        f.seek(fits_data_size(hdr), os.SEEK_CUR)
+        hdr = {**primary, **read_header_blocks(f, first="XTENSION")}
+
+def needs_unpacking(file):
+    # Siril and the numpy engine read the primary HDU of a plain file only.
+    if file.lower().endswith((".gz", ".fz")):
+        return True
+    return read_primary_header(file).get("NAXIS", 0) == 0
+
+def unpack_fits(src, dst):
+    fits = astropy_fits()
+    with fits.open(src) as hdul:
+        hdu = next(h for h in hdul if h.is_image and h.header.get("NAXIS", 0) > 0)
+        header = hdu.header.copy()
+        for key in ("XTENSION", "PCOUNT", "GCOUNT", "EXTNAME", "BSCALE", "BZERO"):
+            header.remove(key, ignore_missing=True, remove_all=True)
+        for card in hdul[0].header.cards:
+            if card.keyword not in header and card.keyword not in ("SIMPLE", "EXTEND", "BITPIX") \
+                    and not card.keyword.startswith("NAXIS"):
+                header.append(card)
+        fits.PrimaryHDU(hdu.data, header).writeto(dst)
+
+FITS_DTYPES = {8: ">u1", 16: ">i2", 32: ">i4", -32: ">f4", -64: ">f8"}
+
+def frame_statistics(file, hdr, data_offset, stride=FRAME_STATS_STRIDE):
+    # Mean, median, robust sigma (1.4826 * MAD) and an estimate of the hot pixel count
+    # of the whole frame, from a strided subsample of the memory-mapped data.
+    if hdr.get("NAXIS") != 2 or hdr.get("BITPIX") not in FITS_DTYPES:
+        return {}
+    data = np.memmap(file, dtype=FITS_DTYPES[hdr["BITPIX"]], mode="r", offset=data_offset,
+                     shape=(hdr["NAXIS2"], hdr["NAXIS1"]))
+    try:
+        sample = data[::stride, ::stride].astype(np.float32) * hdr.get("BSCALE", 1) + hdr.get("BZERO", 0)
+    finally:
+        del data
+    median = float(np.median(sample))
+    sigma = 1.4826 * float(np.median(np.abs(sample - median)))
+    hot = int(np.count_nonzero(sample > median + HOT_PIXEL_SIGMA * max(sigma, 1e-6)))
+    return {
+        "mean": float(sample.mean()),
+        "median": median,
+        "sigma": sigma,
+        "hot_pixels": hot * stride * stride,
+    }
+
+def read_fits_header(file, with_stats=INGEST_FRAME_STATS):
+    try:
+        with open_fits(file) as f:
+            hdr, uncompressed = read_image_header(f)
+            data_offset = f.tell()
+        temp = hdr.get("CCD-TEMP")
+        iso = hdr.get("ISOSPEED")
+        gain = hdr.get("GAIN")
+        if gain is None:
+            gain = hdr.get("EGAIN")
+        exptime = hdr.get("EXPTIME")
+        naxis1 = hdr.get("NAXIS1")
+        naxis2 = hdr.get("NAXIS2")
+        xbin = hdr.get("XBINNING")
+        ybin = hdr.get("YBINNING")
+        if None in (temp, exptime, naxis1, naxis2, xbin, ybin) or (iso is None and gain is None):
+            return None
+        entry = {
+            "path": file,
+            "ccd_temp": temp,
+            "iso": iso,
+            "gain": gain,
+            "exptime": exptime,
+            "naxis1": naxis1,
+            "naxis2": naxis2,
+            "xbinning": xbin,
+            "ybinning": ybin
+        }
     except Exception as e:
         print(f"Error reading {file}: {e}")
         return None
+    # Compressed frames would have to be decompressed to sample them, so they are indexed
+    # without statistics. A frame whose pixels cannot be sampled is still indexed, just ranked last.
+    if with_stats and uncompressed and not file.lower().endswith(".gz"):
+        try:
+            entry.update(frame_statistics(file, hdr, data_offset))
+        except Exception as e:
+            print(f"Could not compute statistics of {file}: {e}")
+    return entry
+
+class operation_cancelled(Exception):
+    pass
+
+class operation_profile:
+    # Wall time per phase plus file/byte counters and the slowest individual files of one
+    # operation. Phases may be entered from several threads; their times are summed.
+    def __init__(self, operation, **info):
+        self.operation = operation
+        self.info = info
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.counters = {}
+        self.outliers = []
+        self.started = time.time()
+        self.profiler = cProfile.Profile() if PROFILE_ENABLED else None
+        self.thread_profilers = []
+        self.local = threading.local()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def file_time(self, phase, path, seconds):
+        if seconds < OUTLIER_SECONDS:
+            return
+        with self.lock:
+            item = (seconds, phase, path)
+            if len(self.outliers) < OUTLIERS_KEPT:
+                heapq.heappush(self.outliers, item)
+            else:
+                heapq.heappushpop(self.outliers, item)
+
+    @contextmanager
+    def profiled(self):
+        # Every thread that runs part of the operation, pool workers included, wraps its
+        # share in this: before Python 3.12 cProfile only sees the thread it is enabled in.
+        # Work handed to worker processes is timed by the phases but not profiled.
+        if self.profiler is None:
+            yield
+        elif not PROFILE_PROCESS_WIDE:
+            with self.thread_profiler():
+                yield
+        else:
+            with self.process_profiler() as joined:
+                if not joined:
+                    print(f"{self.operation}: another profiler is active, not profiling this part")
+                yield
+
+    @contextmanager
+    def thread_profiler(self):
+        # One Profile object must not be enabled from two threads at once, so each thread
+        # records into its own and finish() merges them. Nested calls run under the outer one.
+        if getattr(self.local, "active", False):
+            yield
+            return
+        profiler = getattr(self.local, "profiler", None)
+        if profiler is None:
+            profiler = self.local.profiler = cProfile.Profile()
+            with self.lock:
+                self.thread_profilers.append(profiler)
+        self.local.active = True
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self.local.active = False
+
+    @contextmanager
+    def process_profiler(self):
+        # Work of an operation that overlaps another profiled one shows up in that
+        # operation's profile instead.
+        global ACTIVE_PROFILER, ACTIVE_PROFILER_USERS
+        with PROFILE_LOCK:
+            joined = ACTIVE_PROFILER is self.profiler
+            if ACTIVE_PROFILER is None:
+                try:
+                    self.profiler.enable()
+                    ACTIVE_PROFILER, joined = self.profiler, True
+                except ValueError:
+                    pass
+            if joined:
+                ACTIVE_PROFILER_USERS += 1
+        try:
+            yield joined
+        finally:
+            if joined:
+                with PROFILE_LOCK:
+                    ACTIVE_PROFILER_USERS -= 1
+                    if not ACTIVE_PROFILER_USERS:
+                        self.profiler.disable()
+                        ACTIVE_PROFILER = None
+
+    def summary(self):
+        parts = [f"{name} {seconds:.2f}s" for name, seconds in self.phases.items()]
+        for name, value in self.counters.items():
+            if name.startswith("bytes"):
+                parts.append(f"{value / 1024 ** 2:.0f} MB {name[6:]}")
+            else:
+                parts.append(f"{value} {name}")
+        return ", ".join(parts)
+
+    def finish(self):
+        record = {
+            "operation": self.operation,
+            "started": datetime.fromtimestamp(self.started).isoformat(timespec="seconds"),
+            "wall": round(time.time() - self.started, 3),
+            **self.info,
+            "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+            "counters": self.counters,
+            "outliers": [{"path": path, "phase": phase, "seconds": round(seconds, 3)}
+                         for seconds, phase, path in sorted(self.outliers, reverse=True)],
+        }
+        if self.profiler is not None:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            stamp = datetime.fromtimestamp(self.started).strftime("%Y%m%d-%H%M%S-%f")
+            record["profile"] = os.path.join(PROFILE_DIR, f"{self.operation.replace(' ', '_')}-{stamp}.prof")
+            if PROFILE_PROCESS_WIDE:
+                self.profiler.dump_stats(record["profile"])
+            else:
+                pstats.Stats().add(*self.thread_profilers).dump_stats(record["profile"])
+        try:
+            with open(TIMINGS_LOG, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError as e:
+            print(f"Could not write {TIMINGS_LOG}: {e}")
+        text = self.summary()
+        print(f"{self.operation}: {text}")
+        return text
+
+def profile_phase(profile, name):
+    return profile.phase(name) if profile is not None else nullcontext()
+
+def parallel_map(fn, items, workers=INGEST_WORKERS, use_processes=INGEST_USE_PROCESSES):
+    # Like Executor.map, but keeps at most a few tasks per worker in flight so that
+    # huge or lazily produced inputs are consumed as results stream out.
+    if workers <= 1:
+        yield from map(fn, items)
+        return
+    pool_cls = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with pool_cls(max_workers=workers) as pool:
+        pending = deque()
+        try:
+            for item in items:
+                pending.append(pool.submit(fn, item))
+                if len(pending) >= workers * 4:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+def file_fingerprint(file):
+    st = os.stat(file)
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+def safe_fingerprint(file):
+    try:
+        return file_fingerprint(file)
+    except OSError as e:
+        print(f"Error reading {file}: {e}")
+        return None
+
+def content_hash(file, size, samples=CONTENT_HASH_SAMPLES, chunk=CONTENT_HASH_CHUNK):
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(file, "rb") as f:
+        if samples is None or size <= samples * chunk:
+            for block in iter(lambda: f.read(1024 ** 2), b""):
+                digest.update(block)
+        else:
+            for i in range(samples):
+                f.seek((size - chunk) * i // (samples - 1))
+                digest.update(f.read(chunk))
+    return digest.hexdigest()
+
+def read_fits_entry(file, cached_hash=None):
+    # Fingerprint first: if the file changes while being read, the next rescan sees it as changed again.
+    # cached_hash is a (size, mtime_ns, hash) row of file_hashes, reused while the file is unchanged.
+    start = time.perf_counter()
+    fingerprint = safe_fingerprint(file)
+    if fingerprint is None:
+        return file, None, None, time.perf_counter() - start
+    entry = read_fits_header(file)
+    if entry is not None:
+        if cached_hash is not None and tuple(cached_hash[:2]) == fingerprint[:2]:
+            entry["content_hash"] = cached_hash[2]
+        else:
+            try:
+                entry["content_hash"] = content_hash(file, fingerprint[0])
+            except OSError as e:
+                print(f"Could not hash {file}: {e}")
+    return file, fingerprint, entry, time.perf_counter() - start
+
+def read_fits_item(item):
+    return read_fits_entry(*item)
+
+def path_fingerprint(file):
+    return file, safe_fingerprint(file)
+
+def diff_library(conn, library_id, files, progress=None, cancel=None):
+    # files may be a generator such as iter_fits_files; paths are stat'ed while it walks.
+    # Returns the new or changed paths, the vanished ones and the number of files seen.
+    known = {path: (size, mtime_ns, inode) for path, size, mtime_ns, inode in conn.execute(
+        "SELECT path, size, mtime_ns, inode FROM darks WHERE library_id = ? "
+        "UNION ALL SELECT path, size, mtime_ns, inode FROM skipped_files WHERE library_id = ?",
+        (library_id, library_id))}
+    changed, seen, last = [], set(), 0.0
+    for path, fingerprint in parallel_map(path_fingerprint, files):
+        if cancel is not None and cancel.is_set():
+            raise operation_cancelled()
+        seen.add(path)
+        if fingerprint is None or known.get(path) != fingerprint:
+            changed.append(path)
+        now = time.perf_counter()
+        if progress is not None and now - last >= PROGRESS_INTERVAL:
+            progress(len(seen))
+            last = now
+    vanished = [path for path in known if path not in seen]
+    return changed, vanished, len(seen)
+
+def remove_paths(conn, library_id, paths):
+    params = [(library_id, p) for p in paths]
+    with transaction(conn):
+        conn.executemany("DELETE FROM darks WHERE library_id = ? AND path = ?", params)
+        conn.executemany("DELETE FROM skipped_files WHERE library_id = ? AND path = ?", params)
+
+INSERT_DARK_SQL = f"INSERT INTO darks ({DARK_COLUMNS}) VALUES ({', '.join('?' * 18)})"
+
+INSERT_SKIPPED_SQL = ("INSERT OR REPLACE INTO skipped_files (library_id, path, size, mtime_ns, inode) "
+                      "VALUES (?, ?, ?, ?, ?)")
+
+def dark_row(library_id, entry, fingerprint):
+    return (library_id, entry["path"], entry["ccd_temp"], entry["iso"],
+            entry["gain"], entry["exptime"], entry["naxis1"],
+            entry["naxis2"], entry["xbinning"], entry["ybinning"]) + tuple(fingerprint) + (
+            entry.get("mean"), entry.get("median"), entry.get("sigma"), entry.get("hot_pixels"),
+            entry.get("content_hash"))
+
+INSERT_HASH_SQL = "INSERT OR REPLACE INTO file_hashes (path, size, mtime_ns, content_hash) VALUES (?, ?, ?, ?)"
+
+def find_duplicate(conn, content_hash):
+    return conn.execute("SELECT path FROM darks WHERE content_hash = ? LIMIT 1", (content_hash,)).fetchone()
+
+def list_duplicates(conn, libraries=None):
+    where = (f" WHERE library_id IN ({', '.join('?' * len(libraries))})" if libraries
+             else " WHERE library_id IN (SELECT id FROM libraries)")
+    return conn.execute(f"SELECT path, duplicate_of FROM duplicate_darks{where} ORDER BY duplicate_of, path",
+                        tuple(libraries or ())).fetchall()
+
+def ingest_files(conn, library_id, files, workers=INGEST_WORKERS, use_processes=INGEST_USE_PROCESSES,
+                 progress=None, cancel=None, profile=None):
+    # Rows are committed batch by batch, so a cancelled run leaves a consistent index:
+    # files not reached yet have no row and are picked up by the next rescan.
+    stats = {"files": 0, "inserted": 0, "skipped": 0, "duplicates": 0, "elapsed": 0.0, "rate": 0.0,
+             "cancelled": False}
+    # files may also be a generator, progress is then reported without a total.
+    total = len(files) if hasattr(files, "__len__") else None
+    sqlite_before = profile.phases.get("sqlite", 0.0) if profile is not None else 0.0
+    start = last_report = time.perf_counter()
+    rows, skipped_rows, hash_rows, hashes = [], [], [], set()
+
+    def flush():
+        with profile_phase(profile, "sqlite"), transaction(conn):
+            conn.executemany(INSERT_DARK_SQL, rows)
+            conn.executemany(INSERT_SKIPPED_SQL, skipped_rows)
+            conn.executemany(INSERT_HASH_SQL, hash_rows)
+        rows.clear()
+        skipped_rows.clear()
+        hash_rows.clear()
+
+    def with_cached_hash(files):
+        for path in files:
+            yield path, conn.execute("SELECT size, mtime_ns, content_hash FROM file_hashes WHERE path = ?",
+                                     (path,)).fetchone()
+
+    def profiled_read(item):
+        with profile.profiled():
+            return read_fits_item(item)
+
+    # Worker processes need a picklable function and cannot report to the profiler anyway.
+    read = profiled_read if profile is not None and not use_processes else read_fits_item
+    for path, fingerprint, entry, seconds in parallel_map(read, with_cached_hash(files), workers, use_processes):
+        stats["files"] += 1
+        if profile is not None:
+            profile.file_time("headers", path, seconds)
+        if entry:
+            rows.append(dark_row(library_id, entry, fingerprint))
+            stats["inserted"] += 1
+            digest = entry.get("content_hash")
+            if digest is not None:
+                hash_rows.append((path, fingerprint[0], fingerprint[1], digest))
+                if digest in hashes or find_duplicate(conn, digest):
+                    stats["duplicates"] += 1
+                hashes.add(digest)
+        else:
+            if fingerprint is not None:
+                skipped_rows.append((library_id, path) + tuple(fingerprint))
+            stats["skipped"] += 1
+        if len(rows) + len(skipped_rows) >= INSERT_BATCH_SIZE:
+            flush()
+        now = time.perf_counter()
+        if progress is not None and now - last_report >= PROGRESS_INTERVAL:
+            progress(stats["files"], total, stats["files"] / (now - start))
+            last_report = now
+        if cancel is not None and cancel.is_set():
+            stats["cancelled"] = True
+            break
+    flush()
+    stats["elapsed"] = time.perf_counter() - start
+    if profile is not None:
+        # Header reads overlap on the pool, so this is wall time minus the SQLite share.
+        profile.add_time("headers", stats["elapsed"] - (profile.phases.get("sqlite", 0.0) - sqlite_before))
+        profile.count("files", stats["files"])
+    if stats["elapsed"] > 0:
+        stats["rate"] = stats["files"] / stats["elapsed"]
+    print(f"Ingested {stats['inserted']} of {stats['files']} files in {stats['elapsed']:.1f}s "
+          f"({stats['rate']:.1f} files/s, {stats['skipped']} skipped, {stats['duplicates']} duplicates)")
+    return stats
+
+def relative_index_path(path, root):
+    rel = os.path.relpath(path, root)
+    if rel == os.pardir or rel.startswith(os.pardir + os.sep) or os.path.isabs(rel):
+        return None
+    return rel.replace(os.sep, "/")
+
+def export_library(conn, library_id, root, out_path, cancel=None):
+    # Paths are stored relative to the library root with "/" separators, so the index can
+    # be imported under any mount point and operating system.
+    columns = DARK_COLUMNS.split(", ")[1:]
+    darks = {col: [] for col in columns}
+    for row in conn.execute(f"SELECT {', '.join(columns)} FROM darks WHERE library_id = ?", (library_id,)):
+        if cancel is not None and cancel.is_set():
+            raise operation_cancelled()
+        rel = relative_index_path(row[0], root)
+        if rel is None:
+            continue
+        for col, value in zip(columns, (rel,) + row[1:]):
+            darks[col].append(value)
+    skipped = {col: [] for col in ("path", "size", "mtime_ns")}
+    for path, size, mtime_ns in conn.execute(
+            "SELECT path, size, mtime_ns FROM skipped_files WHERE library_id = ?", (library_id,)):
+        rel = relative_index_path(path, root)
+        if rel is not None:
+            for col, value in zip(skipped, (rel, size, mtime_ns)):
+                skipped[col].append(value)
+    index = {
+        "format": INDEX_FORMAT,
+        "exported": datetime.now().isoformat(timespec="seconds"),
+        "root": root,
+        "darks": darks,
+        "skipped": skipped,
+    }
+    tmp = out_path + ".tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        json.dump(index, f, separators=(",", ":"))
+    os.replace(tmp, out_path)
+    return len(darks["path"])
+
+def index_entry_matches(fingerprint, size, mtime_ns):
+    return (fingerprint is not None and size is not None and mtime_ns is not None and fingerprint[0] == size
+            and abs(fingerprint[1] - mtime_ns) <= IMPORT_MTIME_TOLERANCE_NS)
+
+def read_index(in_path):
+    # Loads and checks an exported index before anything is written to the catalog.
+    with gzip.open(in_path, "rt", encoding="utf-8") as f:
+        index = json.load(f)
+    if index.get("format") != INDEX_FORMAT:
+        raise ValueError(f"Unsupported index format {index.get('format')}")
+    darks, skipped = index.get("darks", {}), index.get("skipped", {})
+    missing = [col for col in DARK_COLUMNS.split(", ")[1:] if col not in darks]
+    missing += [f"skipped {col}" for col in ("path", "size", "mtime_ns") if col not in skipped]
+    if missing:
+        raise ValueError(f"Index file lacks the columns {', '.join(missing)}")
+    if len({len(values) for values in darks.values()}) > 1 or len({len(values) for values in skipped.values()}) > 1:
+        raise ValueError("Index file columns differ in length")
+    return index
+
+def import_library(conn, library_id, root, index, progress=None, cancel=None, profile=None):
+    # index comes from read_index. Entries are checked with a stat per file; only the
+    # ones that differ from the exported fingerprint go through ingest_files. Files not
+    # in the index at all are picked up by the next rescan.
+    def local_path(rel):
+        return os.path.join(root, *rel.split("/"))
+
+    # Rows are built in INSERT_DARK_SQL order, whatever the key order of the file.
+    darks, skipped = index["darks"], index["skipped"]
+    columns = DARK_COLUMNS.split(", ")[1:]
+    rows, skipped_rows, hash_rows, revalidate = [], [], [], []
+    stats = {"imported": 0, "missing": 0}
+    with profile_phase(profile, "fingerprints"):
+        paths = [local_path(rel) for rel in darks["path"]]
+        for i, (path, fingerprint) in enumerate(parallel_map(path_fingerprint, paths)):
+            if fingerprint is None:
+                stats["missing"] += 1
+            elif index_entry_matches(fingerprint, darks["size"][i], darks["mtime_ns"][i]):
+                values = dict(zip(columns, (darks[col][i] for col in columns)), path=path)
+                values.update(zip(("size", "mtime_ns", "inode"), fingerprint))
+                rows.append(tuple([library_id] + [values[col] for col in columns]))
+                if values["content_hash"] is not None:
+                    hash_rows.append((path, fingerprint[0], fingerprint[1], values["content_hash"]))
+            else:
+                revalidate.append(path)
+        paths = [local_path(rel) for rel in skipped["path"]]
+        for i, (path, fingerprint) in enumerate(parallel_map(path_fingerprint, paths)):
+            if fingerprint is None:
+                stats["missing"] += 1
+            elif index_entry_matches(fingerprint, skipped["size"][i], skipped["mtime_ns"][i]):
+                skipped_rows.append((library_id, path) + tuple(fingerprint))
+            else:
+                revalidate.append(path)
+    with profile_phase(profile, "sqlite"):
+        remove_paths(conn, library_id, [row[1] for row in rows] + [row[1] for row in skipped_rows] + revalidate)
+        with transaction(conn):
+            conn.executemany(INSERT_DARK_SQL, rows)
+            conn.executemany(INSERT_SKIPPED_SQL, skipped_rows)
+            conn.executemany(INSERT_HASH_SQL, hash_rows)
+    stats["imported"] = len(rows) + len(skipped_rows)
+    if profile is not None:
+        profile.count("files imported", stats["imported"])
+    print(f"Imported {stats['imported']} entries from the index of {index['root']}, {len(revalidate)} to re-read, "
+          f"{stats['missing']} missing")
+    stats.update(ingest_files(conn, library_id, revalidate, progress=progress, cancel=cancel, profile=profile))
+    return stats
+
+def sort_values(values):
+    try:
+        return sorted(values, key=lambda v: float(v.split("x")[0]) if "x" in v else float(v))
+    except ValueError:
+        return sorted(values)
+
+# temp_min/temp_max are floats (equal for an exact temperature) or None, the other
+# fields hold the dropdown strings with "" meaning "any". temp_target is set for a
+# "target +- tolerance" selection, which then prefers the darks closest to it.
+# libraries lists the library ids to select from, None selects from all of them.
+dark_criteria = namedtuple("dark_criteria",
+                           ["temp_min", "temp_max", "iso", "exptime", "resolution", "binning", "temp_target",
+                            "libraries"],
+                           defaults=(None, None))
+
+def temp_bucket_label(temp, bucket=TEMP_BUCKET):
+    return str(round(temp / bucket) * bucket)
+
+# "iso" is the ISO/Gain dropdown: ISOSPEED, or GAIN for cameras that do not report one.
+CRITERIA_COLUMNS = {
+    "iso": ("COALESCE(iso, gain)",),
+    "exptime": ("exptime",),
+    "resolution": ("naxis1", "naxis2"),
+    "binning": ("xbinning", "ybinning"),
+}
+
+@lru_cache(maxsize=None)
+def criteria_clause(has_temp, set_fields, null_fields, library_count=0):
+    # Only depends on which criteria are set, so the SQL text stays identical between
+    # clicks and sqlite3's per-connection statement cache can reuse the prepared query.
+    where = []
+    if library_count:
+        where.append(f"library_id IN ({', '.join('?' * library_count)})")
+    else:
+        # Rows a late writer left behind for a deleted library are not part of "all".
+        where.append("library_id IN (SELECT id FROM libraries)")
+    if has_temp:
+        where.append("ccd_temp BETWEEN ? AND ?")
+    for field in set_fields:
+        for col in CRITERIA_COLUMNS[field]:
+            where.append(f"{col} IS NULL" if field in null_fields else f"{col} = ?")
+    return " WHERE " + " AND ".join(where)
+
+def typed_value(value):
+    # An expression has no column affinity, so its parameters must carry the stored type.
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+def criteria_where(criteria):
+    params, set_fields, null_fields = list(criteria.libraries or ()), [], []
+    has_temp = criteria.temp_min is not None
+    if has_temp:
+        params += [criteria.temp_min, criteria.temp_max]
+    for field, cols in CRITERIA_COLUMNS.items():
+        value = getattr(criteria, field)
+        if not value:
+            continue
+        set_fields.append(field)
+        if value == "None":
+            null_fields.append(field)
+        else:
+            params.extend(value.split("x") if len(cols) == 2 else [typed_value(value)])
+    return criteria_clause(has_temp, tuple(set_fields), tuple(null_fields), len(criteria.libraries or ())), params
+
+class facet_index:
+    # One row per distinct parameter tuple with its frame count, loaded once per library
+    # (or set of libraries, None meaning all).
+    # Values are kept as the strings shown in the dropdowns, so lookups need no conversion.
+    # Per (iso, exptime, resolution, binning) group the temperatures are also kept sorted
+    # with cumulative counts, so a temperature window is counted with two bisections.
+    FIELDS = ("iso", "exptime", "resolution", "binning")
+
+    def __init__(self, conn, libraries=None):
+        self.temps, self.counts = [], []
+        self.columns = {field: [] for field in self.FIELDS}
+        groups = {}
+        where, params = criteria_where(dark_criteria(None, None, "", "", "", "", libraries=libraries))
+        for temp, iso, exptime, naxis1, naxis2, xbin, ybin, count in conn.execute(f"""
+                SELECT ccd_temp, COALESCE(iso, gain), exptime, naxis1, naxis2, xbinning, ybinning,
+                       COUNT(DISTINCT COALESCE(content_hash, path))
+                FROM darks{where}
+                GROUP BY ccd_temp, COALESCE(iso, gain), exptime, naxis1, naxis2, xbinning, ybinning""", params):
+            self.temps.append(temp)
+            self.counts.append(count)
+            self.columns["iso"].append(str(iso))
+            self.columns["exptime"].append(str(exptime))
+            self.columns["resolution"].append(f"{naxis1}x{naxis2}")
+            self.columns["binning"].append(f"{xbin}x{ybin}")
+            if temp is not None:
+                key = tuple(self.columns[field][-1] for field in self.FIELDS)
+                groups.setdefault(key, []).append((temp, count))
+        self.groups = {}
+        for key, items in groups.items():
+            items.sort()
+            self.groups[key] = ([temp for temp, _ in items], [0] + list(accumulate(c for _, c in items)))
+
+    def group_count(self, key, criteria):
+        temps, cumulative = self.groups[key]
+        if criteria.temp_min is None:
+            return cumulative[-1]
+        return cumulative[bisect_right(temps, criteria.temp_max)] - cumulative[bisect_left(temps, criteria.temp_min)]
+
+    def matching_groups(self, criteria, fields=FIELDS):
+        selected = [(i, getattr(criteria, field)) for i, field in enumerate(self.FIELDS) if field in fields]
+        for key in self.groups:
+            if all(not value or key[i] == value for i, value in selected) and self.group_count(key, criteria):
+                yield key
+
+    def temperatures(self):
+        return sort_values({temp_bucket_label(t) for t in self.temps if t is not None})
+
+    def values(self, field, criteria):
+        i = self.FIELDS.index(field)
+        return sort_values({key[i] for key in self.matching_groups(criteria, fields=())})
+
+    def count(self, criteria):
+        return sum(self.group_count(key, criteria) for key in self.matching_groups(criteria))
+
+def quality_scores(rows):
+    # rows are (median, sigma, hot_pixels) tuples. A frame scores by how far its median
+    # lies from the set's median (light leaks, wrong exposure) plus how much its noise and
+    # hot pixel count exceed the typical frame (amp glow, warm sensor), each in units of
+    # the robust spread across frames. Lower is better, frames without statistics last.
+    stats = [row for row in rows if None not in row]
+    if len(stats) < 3:
+        return [0.0 if None not in row else math.inf for row in rows]
+    centers, spreads = [], []
+    for column in zip(*stats):
+        center = statistics.median(column)
+        centers.append(center)
+        spreads.append(1.4826 * statistics.median(abs(v - center) for v in column) or 1.0)
+    scores = []
+    for row in rows:
+        if None in row:
+            scores.append(math.inf)
+            continue
+        deviations = [(v - c) / sp for v, c, sp in zip(row, centers, spreads)]
+        scores.append(abs(deviations[0]) + max(deviations[1], 0.0) + max(deviations[2], 0.0))
+    return scores
+
+def select_dark_paths(conn, criteria, limit):
+    # idx_darks_criteria serves the group equality plus the temperature window. With a
+    # target temperature the closest darks come first; |dT| is compared at the 0.1 degree
+    # resolution cameras report, so the quality score still orders equally close darks.
+    # Copies of one frame share a content hash; only one of them is considered.
+    where, params = criteria_where(criteria)
+    rows, seen = [], set()
+    for row in conn.execute(f"SELECT path, ccd_temp, median, sigma, hot_pixels, content_hash FROM darks{where}",
+                            params):
+        if row[5] is not None:
+            if row[5] in seen:
+                continue
+            seen.add(row[5])
+        rows.append(row[:5])
+    scores = quality_scores([row[2:] for row in rows])
+    if criteria.temp_target is None:
+        ranked = sorted(range(len(rows)), key=lambda i: scores[i])
+    else:
+        ranked = sorted(range(len(rows)), key=lambda i: (round(abs(rows[i][1] - criteria.temp_target), 1), scores[i]))
+    return [rows[i][0] for i in ranked[:limit]]
+
+class library_session:
+    # Holds the catalog connection while a library is selected; closed on library switch or
+    # delete. library_id is None for the ALL_LIBRARIES entry, which selects across libraries.
+    def __init__(self, name, info):
+        self.name = name
+        self.library_id = info["id"]
+        self.path = info["path"]
+        self.libraries = None if self.library_id is None else (self.library_id,)
+        self.conn = connect_catalog()
+
+    def select_paths(self, criteria, limit):
+        return select_dark_paths(self.conn, criteria, limit)
+
+    def close(self):
+        self.conn.close()
+
+IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x8, 0x40, 0x80, 0x100, 0x200
+IN_DELETE_SELF, IN_MOVE_SELF, IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x400, 0x800, 0x4000, 0x8000, 0x40000000
+
+class inotify_tree:
+    # Recursive inotify watch through libc (Linux only, raises OSError elsewhere). read()
+    # returns (path, is_dir) for every created, written, moved or deleted entry, and None
+    # when the kernel queue overflowed and events were lost.
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+    def __init__(self, root):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}
+        try:
+            self.add_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def add_tree(self, top):
+        for dirpath, _, _ in os.walk(top):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), self.MASK)
+            if wd < 0:
+                # ENOSPC means fs.inotify.max_user_watches is exhausted.
+                raise OSError(ctypes.get_errno(), f"Cannot watch {dirpath}")
+            self.dirs[wd] = dirpath
+
+    def read(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events, offset = [], 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from("iIII", data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b"\0")
+            offset += 16 + length
+            if mask & IN_Q_OVERFLOW:
+                events.append(None)
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            parent = self.dirs.get(wd)
+            if parent is None:
+                continue
+            path = os.path.join(parent, os.fsdecode(name)) if name else parent
+            is_dir = bool(mask & IN_ISDIR) or not name
+            if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+                # Files created before the new directory was watched produce no event of their own.
+                try:
+                    self.add_tree(path)
+                except OSError as e:
+                    print(f"Error watching {path}: {e}")
+                events.extend((f, False) for f in scan_directory(path))
+            events.append((path, is_dir))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+def is_network_path(path):
+    try:
+        with open("/proc/mounts", 'r') as f:
+            mounts = [line.split()[1:3] for line in f]
+    except OSError:
+        return False
+    path = os.path.realpath(path)
+    best, fstype = "", None
+    for mountpoint, fs in mounts:
+        mountpoint = mountpoint.replace("\\040", " ")
+        if (path == mountpoint or path.startswith(mountpoint.rstrip("/") + "/")) and len(mountpoint) > len(best):
+            best, fstype = mountpoint, fs
+    return fstype in NETWORK_FILESYSTEMS
+
+class library_watcher:
+    # Keeps the index of one library current: catches up with a fingerprint diff on start,
+    # then follows inotify events or polls, and upserts or deletes only the affected rows.
+    # Runs on its own thread with its own connection; generation increases after every
+    # applied change so the window can refresh its dropdowns.
+    def __init__(self, library_id, root, mode=WATCH_MODE):
+        self.library_id = library_id
+        self.root = root
+        self.mode = mode
+        self.pending = {}
+        self.generation = 0
+        self.last_change = None
+        self.available = True
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # Waits for the thread, so no update of the library lands after stop() returns.
+        self.stop_event.set()
+        self.thread.join()
+
+    def open_source(self):
+        if self.mode == "poll" or (self.mode == "auto" and is_network_path(self.root)):
+            return None
+        try:
+            return inotify_tree(self.root)
+        except (OSError, AttributeError, TypeError) as e:
+            print(f"inotify unavailable for {self.root} ({e}), polling every {WATCH_POLL_SECONDS:g}s")
+            return None
+
+    def run(self):
+        with closing(connect_catalog()) as conn:
+            source = self.open_source()
+            print(f"Watching {self.root} ({'inotify' if source else 'polling'})")
+            try:
+                self.resync(conn)
+                next_poll = time.monotonic() + WATCH_POLL_SECONDS
+                while not self.stop_event.is_set():
+                    if source is not None:
+                        for event in source.read(WATCH_DEBOUNCE_SECONDS):
+                            if event is None:
+                                self.resync(conn)
+                            else:
+                                self.note_event(conn, *event)
+                    else:
+                        self.stop_event.wait(WATCH_DEBOUNCE_SECONDS)
+                        if time.monotonic() >= next_poll:
+                            self.resync(conn)
+                            next_poll = time.monotonic() + WATCH_POLL_SECONDS
+                    self.apply_settled(conn)
+            except operation_cancelled:
+                pass
+            finally:
+                if source is not None:
+                    source.close()
+
+    def root_available(self):
+        # An unmounted share leaves a missing or empty mount point behind.
+        try:
+            with os.scandir(self.root) as it:
+                return any(True for _ in it)
+        except OSError:
+            return False
+
+    def resync(self, conn):
+        # Rows are only dropped for directories that could be listed: a share that is
+        # offline must not empty the index, or it would all be read again once it is back.
+        errors = []
+        changed, vanished, found = diff_library(conn, self.library_id, iter_fits_files(self.root, errors=errors),
+                                                cancel=self.stop_event)
+        if vanished and (not found or not self.root_available()):
+            if self.available:
+                print(f"{self.root} is not available, keeping its index")
+            self.available = False
+            vanished = []
+        else:
+            self.available = True
+            if errors:
+                prefixes = tuple(os.path.join(d, "") for d in errors)
+                vanished = [path for path in vanished if not path.startswith(prefixes)]
+        for path in changed + vanished:
+            self.note(path)
+
+    def note(self, path):
+        if is_scanned_path(self.root, path):
+            self.pending[path] = time.monotonic()
+
+    def note_event(self, conn, path, is_dir):
+        if not is_dir:
+            self.note(path)
+        elif not os.path.isdir(path):
+            # A deleted or moved-away directory only reports itself; its indexed files are gone too.
+            prefix = os.path.join(path, "")
+            for (known,) in conn.execute(
+                    "SELECT path FROM darks WHERE library_id = ? AND substr(path, 1, ?) = ? "
+                    "UNION ALL SELECT path FROM skipped_files WHERE library_id = ? AND substr(path, 1, ?) = ?",
+                    (self.library_id, len(prefix), prefix) * 2):
+                self.note(known)
+
+    def apply_settled(self, conn):
+        now, wall = time.monotonic(), time.time()
+        present, gone = [], []
+        for path, noted in self.pending.items():
+            if now - noted < WATCH_DEBOUNCE_SECONDS:
+                continue
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                gone.append(path)
+                continue
+            except OSError:
+                continue
+            if 0 <= wall - mtime < WATCH_SETTLE_SECONDS:
+                continue
+            present.append(path)
+        if gone and not self.root_available():
+            # Kept pending until the share is back.
+            gone = []
+        if not present and not gone:
+            return
+        try:
+            remove_paths(conn, self.library_id, present + gone)
+            stats = ingest_files(conn, self.library_id, present, workers=min(INGEST_WORKERS, len(present) or 1),
+                                 cancel=self.stop_event)
+        except Exception as e:
+            # Left pending, retried on the next pass.
+            print(f"Watch update of {self.root} failed: {e}")
+            return
+        for path in present + gone:
+            del self.pending[path]
+        self.last_change = (datetime.now(), stats["inserted"], len(gone))
+        self.generation += 1
+
+def stage_file(src, dst, mode=STAGING_MODE):
+    if needs_unpacking(src):
+        unpack_fits(src, dst)
+        return "unpack"
+    if mode == "auto":
+        if os.stat(src).st_dev == os.stat(os.path.dirname(dst)).st_dev:
+            try:
+                os.link(src, dst)
+                return "hardlink"
+            except OSError:
+                pass
+        try:
+            os.symlink(os.path.abspath(src), dst)
+            return "symlink"
+        except (OSError, NotImplementedError):
+            pass
+    shutil.copy(src, dst)
+    return "copy"
+
+def stage_files(files, staging_dir, mode=STAGING_MODE, cancel=None, profile=None):
+    # Darks from different folders often share a file name, so every staged entry gets
+    # a running number prefix instead of overwriting its namesake.
+    methods = {"hardlink": 0, "symlink": 0, "copy": 0, "unpack": 0}
+    for i, f in enumerate(files, start=1):
+        if cancel is not None and cancel.is_set():
+            raise operation_cancelled()
+        name = re.sub(r"\.(fz|gz)$", "", os.path.basename(f), flags=re.IGNORECASE)
+        dst = os.path.join(staging_dir, f"{i:05d}_{name}")
+        start = time.perf_counter()
+        method = stage_file(f, dst, mode)
+        methods[method] += 1
+        if profile is not None:
+            seconds = time.perf_counter() - start
+            profile.add_time("stage", seconds)
+            profile.file_time("stage", f, seconds)
+            label = {"copy": "bytes copied", "unpack": "bytes unpacked"}.get(method, "bytes linked")
+            profile.count(label, os.path.getsize(dst))
+    print(f"Staged {len(files)} darks: {methods['hardlink']} hardlinked, "
+          f"{methods['symlink']} symlinked, {methods['copy']} copied, {methods['unpack']} unpacked")
+    return methods
+
+@contextmanager
+def staging_dir(parent_dir):
+    # Every stacking run gets its own directory, so runs can be staged concurrently.
+    path = tempfile.mkdtemp(prefix="master_dark_tmp_", dir=parent_dir)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+def resolve_backend(backend=STACK_BACKEND):
+    if backend == "auto":
+        return "siril" if connect_siril() else "numpy"
+    return backend
+
+def stack_staged(tmpdir, master_path, backend=STACK_BACKEND, profile=None):
+    if resolve_backend(backend) == "siril":
+        siril_stack(tmpdir, master_path, profile)
+    else:
+        files = sorted(os.path.join(tmpdir, f) for f in os.listdir(tmpdir))
+        with profile_phase(profile, "stack"):
+            stack_local(files, master_path, float(STACK_PARAMS[1]), float(STACK_PARAMS[2]), profile=profile)
+
+def siril_stack(tmpdir, master_path, profile=None):
+    if not connect_siril():
+        raise RuntimeError("Not connected to Siril.")
+    with SIRIL_LOCK:
+        siril.cmd("cd", tmpdir)
+        try:
+            with profile_phase(profile, "convert"):
+                siril.cmd("convert", "seq_dark")
+            with profile_phase(profile, "stack"):
+                siril.cmd("stack", "seq_dark", *STACK_PARAMS, f"-out={master_path}")
+        finally:
+            siril.cmd("cd", "..")
+
+def winsorized_sigma_clip_mean(cube, sigma_low, sigma_high, max_iterations=10):
+    # Vectorized version of Siril's default winsorized sigma clipping over axis 0 of an
+    # (N, rows, cols) cube: per pixel, sigma is estimated on data winsorized at
+    # median +- 1.5 sigma, values beyond sigma_low/sigma_high are rejected, and this
+    # repeats until nothing changes or only 3 values are left. The mean of the kept
+    # values is returned.
+    keep = np.ones(cube.shape, dtype=bool)
+    for _ in range(max_iterations):
+        masked = np.where(keep, cube, np.nan)
+        median = np.nanmedian(masked, axis=0)
+        sigma = np.nanstd(masked, axis=0)
+        for _ in range(max_iterations):
+            winsorized = np.clip(masked, median - 1.5 * sigma, median + 1.5 * sigma)
+            new_sigma = 1.134 * np.nanstd(winsorized, axis=0)
+            converged = np.all(np.abs(new_sigma - sigma) <= sigma * 0.0005)
+            sigma = new_sigma
+            if converged:
+                break
+        new_keep = keep & (cube >= median - sigma_low * sigma) & (cube <= median + sigma_high * sigma)
+        new_keep = np.where(keep.sum(axis=0) > 3, new_keep, keep)
+        if np.array_equal(new_keep, keep):
+            break
+        keep = new_keep
+    return np.nanmean(np.where(keep, cube, np.nan), axis=0).astype(np.float32)
+
+def stack_local(files, master_path, sigma_low=3.0, sigma_high=3.0,
+                workers=LOCAL_STACK_WORKERS, tile_bytes=LOCAL_STACK_TILE_BYTES, profile=None):
+    # Frames are memory-mapped and read one band of rows at a time, and the result is
+    # streamed to disk band by band, so peak memory does not grow with the frame count.
+    fits = astropy_fits()
+    hduls = [fits.open(f, memmap=True, do_not_scale_image_data=True) for f in files]
+    try:
+        frames = []
+        for f, hdul in zip(files, hduls):
+            hdu = hdul[0]
+            if hdu.data is None or hdu.data.ndim != 2:
+                raise ValueError(f"{f} is not a 2-D image")
+            bitpix = hdu.header["BITPIX"]
+            # Integer data is scaled to [0, 1] like Siril does for its 32-bit float output.
+            norm = {8: 255.0, 16: 65535.0}.get(bitpix, 1.0)
+            frames.append((hdu.data, hdu.header.get("BSCALE", 1.0), hdu.header.get("BZERO", 0.0), norm))
+        height, width = frames[0][0].shape
+        if any(data.shape != (height, width) for data, _, _, _ in frames):
+            raise ValueError("Darks differ in image size")
+        rows = max(1, tile_bytes // (workers * LOCAL_STACK_CLIP_FACTOR * len(frames) * width * 4))
+
+        def stack_band(start):
+            with profile.profiled() if profile is not None else nullcontext():
+                cube = np.empty((len(frames), min(rows, height - start), width), dtype=np.float32)
+                for i, (data, bscale, bzero, norm) in enumerate(frames):
+                    cube[i] = (data[start:start + rows].astype(np.float32) * bscale + bzero) / norm
+                return winsorized_sigma_clip_mean(cube, sigma_low, sigma_high)
+
+        header = fits.Header([("SIMPLE", True), ("BITPIX", -32), ("NAXIS", 2),
+                              ("NAXIS1", width), ("NAXIS2", height)])
+        first = hduls[0][0].header
+        for key in ("INSTRUME", "EXPTIME", "CCD-TEMP", "ISOSPEED", "GAIN", "XBINNING", "YBINNING"):
+            if key in first:
+                header[key] = first[key]
+        header["IMAGETYP"] = "Master Dark"
+        header["NCOMBINE"] = len(files)
+        header["HISTORY"] = f"Winsorized sigma clipping {sigma_low} {sigma_high}, mean"
+        tmp_path = master_path + ".part"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        stream = fits.StreamingHDU(tmp_path, header)
+        try:
+            for band in parallel_map(stack_band, range(0, height, rows), workers):
+                stream.write(band)
+        finally:
+            stream.close()
+        os.replace(tmp_path, master_path)
+    finally:
+        for hdul in hduls:
+            hdul.close()
+
+def master_cache_key(files, params=STACK_PARAMS):
+    # Fingerprints are taken from disk, not from the index, so a dark replaced since
+    # the last rescan still invalidates the cached master.
+    h = hashlib.sha256(" ".join(params).encode())
+    for path in sorted(files):
+        h.update(f"\0{path}\0{file_fingerprint(path)}".encode())
+    return h.hexdigest()
+
+def lookup_master(conn, key):
+    row = conn.execute("SELECT path FROM masters WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        return None
+    with transaction(conn):
+        if not os.path.exists(row[0]):
+            conn.execute("DELETE FROM masters WHERE key = ?", (key,))
+            return None
+        conn.execute("UPDATE masters SET last_used = ? WHERE key = ?", (time.time(), key))
+    return row[0]
+
+def forget_master_path(conn, path):
+    # Master names only hold the criteria, frame count and date, so a rebuild with other
+    # frames can overwrite a cached file; the entries pointing at it are then stale.
+    with transaction(conn):
+        conn.execute("DELETE FROM masters WHERE path = ?", (path,))
+
+def record_master(conn, key, path, frames):
+    now = time.time()
+    with transaction(conn):
+        conn.execute("DELETE FROM masters WHERE path = ? AND key != ?", (path, key))
+        conn.execute("INSERT OR REPLACE INTO masters (key, path, frames, size, created, last_used) "
+                     "VALUES (?, ?, ?, ?, ?, ?)", (key, path, frames, os.path.getsize(path), now, now))
+    evict_masters(conn)
+
+def evict_masters(conn, max_bytes=MASTER_CACHE_MAX_BYTES, max_entries=MASTER_CACHE_MAX_ENTRIES):
+    rows = conn.execute("SELECT key, path, size FROM masters ORDER BY last_used DESC").fetchall()
+    total, evicted = 0, []
+    for i, (key, path, size) in enumerate(rows):
+        total += size or 0
+        # The most recently used master is always kept, even if it alone exceeds the limit.
+        if i > 0 and ((max_entries and i >= max_entries) or (max_bytes and total > max_bytes)):
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except OSError as e:
+                print(f"Could not evict master {path}: {e}")
+                continue
+            evicted.append((key,))
+    if evicted:
+        with transaction(conn):
+            conn.executemany("DELETE FROM masters WHERE key = ?", evicted)
+        print(f"Evicted {len(evicted)} cached master darks")
+
+def backend_cache_params(backend=STACK_BACKEND):
+    # Siril masters keep their original keys; other backends get their own entries.
+    backend = resolve_backend(backend)
+    return STACK_PARAMS if backend == "siril" else STACK_PARAMS + (backend,)
+
+# Batch mode runs build_master_dark, the window's master_queue runs the same steps split
+# over its staging and stacking threads: select_master_frames, master_output_path,
+# lookup_master by master_cache_key, stage_files and stack_master.
+
+def select_master_frames(conn, criteria, frames, profile=None):
+    with profile_phase(profile, "select"):
+        files = select_dark_paths(conn, criteria, frames)
+    if len(files) < 2:
+        raise ValueError("At least 2 darks required for stacking.")
+    if profile is not None:
+        profile.count("files", len(files))
+    return files
+
+def master_output_path(target_dir, library_name, criteria, frames):
+    outdir = master_output_dir(target_dir, library_name, criteria.exptime)
+    os.makedirs(outdir, exist_ok=True)
+    return os.path.join(outdir, master_name(criteria, frames))
+
+def stack_master(conn, tmpdir, master_path, key, frames, backend=STACK_BACKEND, profile=None):
+    # The cache entries of a master about to be overwritten are dropped first, so a
+    # failed rebuild cannot leave them pointing at a broken or different file.
+    with profile_phase(profile, "sqlite"):
+        forget_master_path(conn, master_path)
+    stack_staged(tmpdir, master_path, backend, profile)
+    if not os.path.exists(master_path):
+        raise RuntimeError("Stacking did not write the master dark.")
+    with profile_phase(profile, "sqlite"):
+        record_master(conn, key, master_path, frames)
+
+def build_master_dark(conn, files, staging_parent, master_path, cancel=None, backend=STACK_BACKEND, profile=None):
+    # Returns the path of the master and whether it was served from the cache.
+    key = master_cache_key(files, backend_cache_params(backend))
+    cached = lookup_master(conn, key)
+    if cached:
+        return cached, True
+    with staging_dir(staging_parent) as tmpdir:
+        stage_files(files, tmpdir, cancel=cancel, profile=profile)
+        # A running Siril command cannot be interrupted, this is the last point to cancel.
+        if cancel is not None and cancel.is_set():
+            raise operation_cancelled()
+        stack_master(conn, tmpdir, master_path, key, len(files), backend, profile)
+    return master_path, False
+
+def master_name(criteria, stack_cnt):
+    if criteria.temp_target is not None:
+        temp = str(criteria.temp_target)
+    elif criteria.temp_min == criteria.temp_max:
+        temp = str(criteria.temp_min)
+    else:
+        temp = f"{criteria.temp_min}-{criteria.temp_max}"
+    current_date = datetime.today().strftime('%Y-%m-%d')
+    return (f"master-dark_iso{criteria.iso}_{criteria.exptime}s_{temp}c_{criteria.resolution}"
+            f"_bin{criteria.binning}_{stack_cnt}x_{current_date}.fit")
+
+def master_output_dir(target_dir, library_name, exptime):
+    lib_name = re.sub(r'[^A-Za-z0-9_-]', '_', library_name)
+    return os.path.join(target_dir, lib_name, f"{exptime}s")
+
+master_job = namedtuple("master_job", ["library", "criteria", "frames", "target_dir"])
+
+def plan_master_jobs(conn, library_name, target_dir, max_frames=None, temp_bucket=BATCH_TEMP_BUCKET,
+                     libraries=None):
+    # One job per (iso, exptime, resolution, binning, temperature bucket). The temperature
+    # range of a job is the observed min/max inside its bucket, so ranges never overlap.
+    # Buckets are centred on whole multiples of temp_bucket like temp_bucket_label, so
+    # the readings around one cooler setpoint end up in one master.
+    # The darks of all given library ids are pooled, None pools every library.
+    facets = facet_index(conn, libraries)
+    groups = {}
+    for i, temp in enumerate(facets.temps):
+        if temp is None:
+            continue
+        key = tuple(facets.columns[field][i] for field in facet_index.FIELDS) + (round(temp / temp_bucket),)
+        tmin, tmax, count = groups.get(key, (temp, temp, 0))
+        groups[key] = (min(tmin, temp), max(tmax, temp), count + facets.counts[i])
+    jobs = []
+    for key, (tmin, tmax, count) in sorted(groups.items(), key=lambda item: [str(v) for v in item[0]]):
+        frames = min(count, max_frames) if max_frames else count
+        if frames < 2:
+            continue
+        iso, exptime, resolution, binning = key[:4]
+        criteria = dark_criteria(tmin, tmax, iso, exptime, resolution, binning, libraries=libraries)
+        jobs.append(master_job(library_name, criteria, frames, target_dir))
+    return jobs
+
+def run_master_job(job, backend=STACK_BACKEND):
+    # Runs on a scheduler thread, so it uses its own connection.
+    profile = operation_profile("master dark", library=job.library, criteria=list(job.criteria))
+    with profile.profiled(), closing(connect_catalog()) as conn:
+        files = select_master_frames(conn, job.criteria, job.frames, profile)
+        master_path = master_output_path(job.target_dir, job.library, job.criteria, len(files))
+        result = build_master_dark(conn, files, job.target_dir, master_path, backend=backend, profile=profile)
+    profile.finish()
+    return result
+
+def run_master_jobs(jobs, concurrency=BATCH_JOBS, backend=STACK_BACKEND):
+    # Staging runs concurrently; the Siril part of each job is serialized by SIRIL_LOCK,
+    # so with concurrency > 1 the next job is staged while the current one is stacked.
+    results = {"created": 0, "cached": 0, "failed": 0}
+
+    def run(job):
+        try:
+            return job, run_master_job(job, backend), None
+        except Exception as e:
+            return job, None, e
+
+    for i, (job, result, error) in enumerate(parallel_map(run, jobs, concurrency), start=1):
+        label = master_name(job.criteria, job.frames)
+        if error is not None:
+            results["failed"] += 1
+            print(f"[{i}/{len(jobs)}] {label}: failed: {error}")
+            continue
+        path, cached = result
+        results["cached" if cached else "created"] += 1
+        print(f"[{i}/{len(jobs)}] {path}: {'up to date' if cached else 'created'}")
+    return results
+
+def run_batch(args):
+    # --batch takes one library name, several separated by commas, or "all".
+    with closing(connect_catalog()) as conn:
+        libraries = load_libraries(conn)
+        if args.library == "all":
+            names, ids = list(libraries), None
+        else:
+            names = [name.strip() for name in args.library.split(",")]
+            unknown = [name for name in names if name not in libraries]
+            if unknown:
+                print(f"Unknown library '{unknown[0]}'. Known libraries: {', '.join(libraries) or 'none'}")
+                return 2
+            ids = tuple(libraries[name]["id"] for name in names)
+        label = "+".join(names) if ids else ALL_LIBRARIES
+        jobs = plan_master_jobs(conn, label, args.target, args.max_frames, args.temp_bucket, ids)
+    print(f"Planned {len(jobs)} master darks for {', '.join(names)}")
+    if args.dry_run:
+        for job in jobs:
+            print(f"  {master_name(job.criteria, job.frames)}")
+        return 0
+    results = run_master_jobs(jobs, args.jobs, args.backend)
+    print(f"{results['created']} created, {results['cached']} up to date, {results['failed']} failed")
+    return 1 if results["failed"] else 0
+
+def run_watch(name):
+    libraries = load_libraries()
+    if name not in libraries:
+        print(f"Unknown library '{name}'. Known libraries: {', '.join(libraries) or 'none'}")
+        return 2
+    watcher = library_watcher(libraries[name]["id"], libraries[name]["path"])
+    generation = 0
+    try:
+        while watcher.thread.is_alive():
+            watcher.thread.join(1.0)
+            if watcher.generation != generation:
+                generation = watcher.generation
+                when, indexed, removed = watcher.last_change
+                print(f"{when:%H:%M:%S}: {indexed} indexed, {removed} removed")
+    except KeyboardInterrupt:
+        watcher.stop()
+        return 0
+    # The watcher thread only ends on its own after an error.
+    return 1
+
+def run_export(name, out_path):
+    with closing(connect_catalog()) as conn:
+        libraries = load_libraries(conn)
+        if name not in libraries:
+            print(f"Unknown library '{name}'. Known libraries: {', '.join(libraries) or 'none'}")
+            return 2
+        count = export_library(conn, libraries[name]["id"], libraries[name]["path"], out_path)
+    print(f"Exported {count} darks of '{name}' to {out_path}")
+    return 0
+
+def run_duplicates(name):
+    with closing(connect_catalog()) as conn:
+        libraries = load_libraries(conn)
+        if name != "all" and name not in libraries:
+            print(f"Unknown library '{name}'. Known libraries: {', '.join(libraries) or 'none'}")
+            return 2
+        duplicates = list_duplicates(conn, None if name == "all" else (libraries[name]["id"],))
+    for path, original in duplicates:
+        print(f"{path}\n    duplicate of {original}")
+    print(f"{len(duplicates)} duplicate darks in {'all libraries' if name == 'all' else repr(name)}")
+    return 0
+
+def run_import(name, root, in_path):
+    try:
+        index = read_index(in_path)
+    except (OSError, ValueError) as e:
+        print(f"Could not read index {in_path}: {e}")
+        return 2
+    profile = operation_profile("import index", library=name)
+    with closing(connect_catalog()) as conn:
+        if name in load_libraries(conn):
+            print(f"Library '{name}' already exists.")
+            return 2
+        library_id = add_library(conn, name, root)
+        stats = import_library(conn, library_id, root, index, profile=profile)
+    print(f"{stats['imported']} entries imported, {stats['inserted']} darks re-read, {stats['missing']} missing")
+    profile.finish()
+    return 0
+
+class master_queue:
+    # Two-stage pipeline: the staging thread selects and links the darks of the next job
+    # while the stacking thread runs Siril on the previous one. stack_q holds a single
+    # staged job, so staging never runs more than one job ahead. Jobs are persisted to
+    # QUEUE_FILE and unfinished ones are resumed on the next start. Jobs can be cancelled
+    # until their stacking starts; cancel events are kept apart as jobs are saved as JSON.
+    ACTIVE = ("queued", "staging", "staged", "stacking")
+    CANCELLABLE = ("queued", "staging", "staged")
+
+    def __init__(self, path=QUEUE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.jobs = []
+        self.cancel_events = {}
+        self.stage_q = queue.Queue()
+        self.stack_q = queue.Queue(maxsize=1)
+        self.load()
+        threading.Thread(target=self.stage_loop, daemon=True).start()
+        threading.Thread(target=self.stack_loop, daemon=True).start()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                jobs = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Could not load job queue {self.path}: {e}")
+            return
+        libraries = None
+        for job in jobs:
+            if "db" in job:
+                # Queued before the catalog: the library is looked up by name instead of its database.
+                libraries = libraries or load_libraries()
+                del job["db"]
+                if job["library"] in libraries:
+                    job["criteria"] = job["criteria"][:7] + [[libraries[job["library"]]["id"]]]
+                elif job["status"] in self.ACTIVE:
+                    job.update(status="failed", staging=None, error="library no longer exists")
+            if job["status"] in self.ACTIVE:
+                # Interrupted by a restart: start over with a fresh staging directory.
+                if job["staging"]:
+                    shutil.rmtree(job["staging"], ignore_errors=True)
+                job.update(status="queued", staging=None)
+                self.stage_q.put(job)
+            self.jobs.append(job)
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.jobs, f, indent=2)
+        os.replace(tmp, self.path)
+
+    def update(self, job, **changes):
+        with self.lock:
+            job.update(changes)
+            if job["status"] not in self.ACTIVE:
+                self.cancel_events.pop(job["id"], None)
+            self.save()
+
+    def submit(self, library, criteria, frames, target_dir):
+        with self.lock:
+            job = {
+                "id": max((j["id"] for j in self.jobs), default=0) + 1,
+                "library": library,
+                "criteria": list(criteria),
+                "frames": frames,
+                "target_dir": target_dir,
+                "status": "queued",
+                "staging": None,
+                "master": None,
+                "error": None,
+                "timings": None,
+            }
+            self.jobs.append(job)
+            self.save()
+        self.stage_q.put(job)
+        return job
+
+    def cancel_event(self, job):
+        with self.lock:
+            return self.cancel_events.setdefault(job["id"], threading.Event())
+
+    def cancel(self, job_id):
+        # Queued jobs are cancelled right away, staging and staged ones by their thread.
+        with self.lock:
+            for job in self.jobs:
+                if job["id"] == job_id and job["status"] in self.CANCELLABLE:
+                    self.cancel_events.setdefault(job_id, threading.Event()).set()
+                    if job["status"] == "queued":
+                        job["status"] = "cancelled"
+            self.save()
+
+    def start(self, job, expected, status):
+        # Moves job on unless it was cancelled in the meantime.
+        with self.lock:
+            cancelled = self.cancel_events.get(job["id"])
+            if job["status"] != expected or (cancelled is not None and cancelled.is_set()):
+                return False
+            job["status"] = status
+            self.save()
+            return True
+
+    def cancelled(self, job):
+        print(f"Job {job['id']} cancelled")
+        if job["staging"]:
+            shutil.rmtree(job["staging"], ignore_errors=True)
+        self.update(job, status="cancelled", staging=None)
+
+    def clear_finished(self):
+        with self.lock:
+            self.jobs = [job for job in self.jobs if job["status"] in self.ACTIVE]
+            self.save()
+
+    def summary(self):
+        with self.lock:
+            counts = {}
+            for job in self.jobs:
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+        return counts
+
+    def fail(self, job, error):
+        print(f"Job {job['id']} failed: {error}")
+        if job["staging"]:
+            shutil.rmtree(job["staging"], ignore_errors=True)
+        self.update(job, status="failed", staging=None, error=str(error))
+
+    def stage_loop(self):
+        while True:
+            job = self.stage_q.get()
+            if not self.start(job, "queued", "staging"):
+                continue
+            cancel = self.cancel_event(job)
+            profile = operation_profile("master dark", library=job["library"], criteria=job["criteria"])
+            try:
+                criteria = dark_criteria(*job["criteria"])
+                with profile.profiled(), closing(connect_catalog()) as conn:
+                    files = select_master_frames(conn, criteria, job["frames"], profile)
+                    with profile.phase("select"):
+                        key = master_cache_key(files, backend_cache_params())
+                        cached = lookup_master(conn, key)
+                if cached:
+                    self.update(job, status="up to date", master=cached)
+                    continue
+                master_path = master_output_path(job["target_dir"], job["library"], criteria, len(files))
+                # Kept past this thread for the stacking one, so not a staging_dir() context.
+                tmpdir = tempfile.mkdtemp(prefix="master_dark_tmp_", dir=job["target_dir"])
+                self.update(job, staging=tmpdir, master=master_path)
+                with profile.profiled():
+                    stage_files(files, tmpdir, cancel=cancel, profile=profile)
+                if not self.start(job, "staging", "staged"):
+                    raise operation_cancelled()
+                self.stack_q.put((job, key, len(files), profile))
+            except operation_cancelled:
+                self.cancelled(job)
+            except Exception as e:
+                self.fail(job, e)
+
+    def stack_loop(self):
+        while True:
+            job, key, frames, profile = self.stack_q.get()
+            try:
+                # A running Siril command cannot be interrupted, this is the last point to cancel.
+                if not self.start(job, "staged", "stacking"):
+                    self.cancelled(job)
+                    continue
+                with profile.profiled(), closing(connect_catalog()) as conn:
+                    stack_master(conn, job["staging"], job["master"], key, frames, profile=profile)
+                shutil.rmtree(job["staging"], ignore_errors=True)
+                self.update(job, status="done", staging=None, timings=profile.finish())
+            except Exception as e:
+                self.fail(job, e)
 
 class dark_o_mat:
     def __init__(self, root):
@@ -97,8 +2073,19 @@ class dark_o_mat:
         self.root.title("FITS Dark-O-Mat - 2025.08-1")
         self.libraries = load_libraries()
         self.selected_library = tk.StringVar()
+        self.facets = {}
+        self.session = None
+        self.worker = None
+        self.cancel_event = threading.Event()
+        self.jobs = master_queue()
+        self.job_tree = None
+        self.watcher = None
+        self.watcher_name = None
+        self.watch_generation = 0
         self.create_widgets()
         self.update_library_dropdown()
+        threading.Thread(target=connect_siril, daemon=True).start()
+        self.refresh_jobs()
 
     def create_widgets(self):
         frame = ttk.Frame(self.root, padding=10)
@@ -107,7 +2094,7 @@ class dark_o_mat:
         ttk.Label(frame, text="Select existing library:").grid(row=0, column=0, sticky="w")
         self.library_combo = ttk.Combobox(frame, textvariable=self.selected_library, width=40, state="readonly")
         self.library_combo.grid(row=0, column=1, sticky="ew")
-        self.library_combo.bind("<<ComboboxSelected>>", lambda e: self.populate_criteria())
+        self.library_combo.bind("<<ComboboxSelected>>", lambda e: [self.populate_criteria(), self.update_watcher()])
 
         frame.grid_columnconfigure(0, weight=0)
         frame.grid_columnconfigure(1, weight=1)
@@ -121,6 +2108,12 @@ class dark_o_mat:
         ttk.Button(button_frame, text="Add new library", command=self.add_new_library_dialog).grid(row=0, column=0, sticky="ew", padx=2)
         ttk.Button(button_frame, text="Delete library",  command=self.delete_library).grid(row=0, column=1, sticky="ew", padx=2)
         ttk.Button(button_frame, text="Rescan",          command=self.rescan_library).grid(row=0, column=2, sticky="ew", padx=2)
+        self.watch_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(button_frame, text="Watch folder", variable=self.watch_var,
+                        command=self.update_watcher).grid(row=1, column=0, sticky="w", padx=2, pady=(5, 0))
+        self.watch_text = tk.StringVar()
+        ttk.Button(button_frame, text="Export index", command=self.export_index).grid(row=1, column=2, sticky="ew", padx=2, pady=(5, 0))
+        ttk.Label(button_frame, textvariable=self.watch_text).grid(row=2, column=0, columnspan=3, sticky="w", padx=2)
 
         self.criteria_frame = ttk.LabelFrame(frame, text="Master Dark Settings")
         self.criteria_frame.grid(row=3, column=0, columnspan=3, sticky="ew", pady=10)
@@ -133,6 +2126,7 @@ class dark_o_mat:
         )
         self.res_var, self.bin_var = tk.StringVar(), tk.StringVar()
         self.temp_range_var = tk.BooleanVar(value=False)
+        self.temp_tol_var = tk.StringVar(value=f"±{TEMP_TOLERANCES[0]:g}")
 
         ttk.Label(self.criteria_frame, text="Temperature").grid(row=0, column=0, sticky="w")
         self.temp_cb = ttk.Combobox(
@@ -160,6 +2154,15 @@ class dark_o_mat:
         )
         self.temp_max_cb.grid(row=1, column=1, sticky="ew")
         self.temp_max_cb.bind("<<ComboboxSelected>>", lambda e: [self.filter_dropdowns_by_temp(), self.update_matching_files(), self.check_all_selected()])
+        self.temp_tol_cb = ttk.Combobox(
+            self.criteria_frame,
+            textvariable=self.temp_tol_var,
+            values=[f"±{tol:g}" for tol in TEMP_TOLERANCES],
+            state="readonly",
+            width=5
+        )
+        self.temp_tol_cb.grid(row=1, column=2, sticky="w")
+        self.temp_tol_cb.bind("<<ComboboxSelected>>", lambda e: [self.filter_dropdowns_by_temp(), self.update_matching_files()])
 
         other_criteria = [
             ("ISO/Gain", self.iso_var, "iso_cb"),
@@ -203,14 +2206,32 @@ class dark_o_mat:
             state="disabled"
         )
         self.create_btn.grid(row=10, column=0, columnspan=2, pady=10)
+        ttk.Button(self.criteria_frame, text="Jobs", command=self.show_jobs).grid(row=10, column=2, pady=10)
+        self.jobs_text = tk.StringVar()
+        ttk.Label(self.criteria_frame, textvariable=self.jobs_text).grid(row=11, column=0, columnspan=3, sticky="w")
+
+        progress_frame = ttk.Frame(frame)
+        progress_frame.grid(row=4, column=0, columnspan=3, sticky="ew")
+        progress_frame.grid_columnconfigure(0, weight=1)
+        self.progress_text = tk.StringVar()
+        ttk.Label(progress_frame, textvariable=self.progress_text).grid(row=0, column=0, columnspan=2, sticky="w")
+        self.progress_bar = ttk.Progressbar(progress_frame, orient="horizontal", mode="determinate")
+        self.progress_bar.grid(row=1, column=0, sticky="ew")
+        self.cancel_btn = ttk.Button(progress_frame, text="Cancel", command=self.cancel_background, state="disabled")
+        self.cancel_btn.grid(row=1, column=1, padx=(5, 0))
+        self.siril_text = tk.StringVar(value="Siril: connecting...")
+        ttk.Label(progress_frame, textvariable=self.siril_text).grid(row=2, column=0, columnspan=2, sticky="w")
+        self.busy_widgets = [self.library_combo, self.create_btn] + list(button_frame.winfo_children())
 
     def on_temp_range_toggle(self):
         if self.temp_range_var.get():
             self.temp_cb.config(state="readonly")
             self.temp_max_cb.config(state="readonly")
+            self.temp_tol_cb.config(state="disabled")
         else:
             self.temp_max_var.set("")
             self.temp_max_cb.config(state="disabled")
+            self.temp_tol_cb.config(state="readonly")
         self.filter_dropdowns_by_temp()
         self.update_matching_files()
         self.check_all_selected()
@@ -219,7 +2240,8 @@ class dark_o_mat:
         self.slider_value.set(str(int(float(self.slider.get()))))
 
     def update_library_dropdown(self):
-        self.library_combo["values"] = list(self.libraries.keys())
+        names = list(self.libraries.keys())
+        self.library_combo["values"] = names + [ALL_LIBRARIES] if len(names) > 1 else names
 
     def add_new_library_dialog(self):
         dialog = tk.Toplevel(self.root)
@@ -236,125 +2258,348 @@ class dark_o_mat:
                 path_var.set(dirpath)
 
         ttk.Button(dialog, text="Browse", command=browse).grid(row=1, column=2, padx=5, pady=5)
+        index_var = tk.StringVar()
+        ttk.Label(dialog, text="Index file (optional):").grid(row=2, column=0, sticky="w", padx=5, pady=5)
+        ttk.Entry(dialog, textvariable=index_var, width=30, state="readonly").grid(row=2, column=1, padx=5, pady=5)
+
+        def browse_index():
+            filepath = filedialog.askopenfilename(title="Select exported library index",
+                                                  filetypes=[("Library index", "*.json.gz"), ("All files", "*")])
+            if filepath:
+                index_var.set(filepath)
+
+        ttk.Button(dialog, text="Browse", command=browse_index).grid(row=2, column=2, padx=5, pady=5)
 
         def confirm():
-            name, path = name_var.get().strip(), path_var.get().strip()
+            name, path, index_path = name_var.get().strip(), path_var.get().strip(), index_var.get().strip()
             if not name or not path:
                 messagebox.showerror("Error", "Name and directory must be provided.")
                 return
-            db_path = os.path.join(DB_DIR, f"{name}.sqlite")
-            self.libraries[name] = {"path": path, "db": db_path}
-            save_libraries(self.libraries)
-            create_db(db_path)
-            fits_files = scan_directory(path)
+            if name == ALL_LIBRARIES:
+                messagebox.showerror("Error", f"'{name}' is reserved, please choose another name.")
+                return
+            if index_path:
+                # An index is only imported into a new library, as with --import.
+                if name in self.libraries:
+                    messagebox.showerror("Error", f"Library '{name}' already exists.")
+                    return
+                profile = operation_profile("import index", library=name)
+
+                def work(progress, cancel):
+                    # The library is only created once the index file has been read and checked.
+                    index = read_index(index_path)
+                    with profile.profiled(), closing(connect_catalog()) as conn:
+                        library_id = add_library(conn, name, path)
+                        return import_library(conn, library_id, path, index, progress=progress, cancel=cancel,
+                                              profile=profile)
+
+                self.run_in_background("Importing index", work, lambda stats: imported(name, stats, profile.finish()))
+                return
+            with closing(connect_catalog()) as conn:
+                library_id = add_library(conn, name, path)
+                self.libraries = load_libraries(conn)
+            profile = operation_profile("add library", library=name)
+
+            def scan(progress, cancel):
+                fits_files, last = [], 0.0
+                with profile.profiled(), profile.phase("walk"):
+                    for f in iter_fits_files(path):
+                        if cancel.is_set():
+                            raise operation_cancelled()
+                        fits_files.append(f)
+                        now = time.perf_counter()
+                        if now - last >= PROGRESS_INTERVAL:
+                            progress(len(fits_files))
+                            last = now
+                return sorted(fits_files)
+
+            self.run_in_background("Scanning directory", scan,
+                                   lambda fits_files: ask_inventarisation(name, library_id, fits_files, profile))
+
+        def ask_inventarisation(name, library_id, fits_files, profile):
             resp = messagebox.askyesno("Scan results", f"Found {len(fits_files)} FITS files. Proceed with inventarisation?")
             if not resp:
                 dialog.destroy()
                 return
-            with sqlite3.connect(db_path) as conn:
-                c = conn.cursor()
-                for f in fits_files:
-                    entry = read_fits_header(f)
-                    if entry:
-                        c.execute("""
-                            INSERT INTO darks (path, ccd_temp, iso, gain, exptime,
-                                               naxis1, naxis2, xbinning, ybinning)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                                  (entry["path"], entry["ccd_temp"], entry["iso"],
-                                   entry["gain"], entry["exptime"], entry["naxis1"],
-                                   entry["naxis2"], entry["xbinning"], entry["ybinning"]))
-                conn.commit()
+
+            def work(progress, cancel):
+                with profile.profiled(), closing(connect_catalog()) as conn:
+                    return ingest_files(conn, library_id, fits_files, progress=progress, cancel=cancel,
+                                        profile=profile)
+
+            self.run_in_background("Reading headers", work, lambda stats: done(name, stats, profile.finish()))
+
+        def done(name, stats, timings):
+            self.invalidate_facets(name)
+            self.update_library_dropdown()
+            self.selected_library.set(name)
+            if dialog.winfo_exists():
+                dialog.destroy()
+            if stats["cancelled"]:
+                messagebox.showinfo("Scan cancelled", f"Library '{name}' created, {stats['inserted']} darks indexed "
+                                                      f"before cancelling.\nUse Rescan to index the remaining files.")
+            else:
+                messagebox.showinfo("Scan complete", f"Library '{name}' created and scanned successfully.\n"
+                                                     f"{stats['inserted']} darks indexed ({stats['duplicates']} duplicates), "
+                                                     f"{stats['skipped']} skipped ({stats['rate']:.0f} files/s).\n\n{timings}")
+            self.populate_criteria()
+
+        def imported(name, stats, timings):
+            self.libraries = load_libraries()
+            self.invalidate_facets(name)
             self.update_library_dropdown()
             self.selected_library.set(name)
-            dialog.destroy()
-            messagebox.showinfo("Scan complete", f"Library '{name}' created and scanned successfully.")
+            if dialog.winfo_exists():
+                dialog.destroy()
+            messagebox.showinfo("Import complete", f"Library '{name}' created from index.\n"
+                                                   f"{stats['imported']} entries taken over, {stats['inserted']} darks "
+                                                   f"re-read, {stats['missing']} files missing.\n"
+                                                   f"Use Rescan to index files added since the export.\n\n{timings}")
             self.populate_criteria()
 
-        ttk.Button(dialog, text="Create library", command=confirm).grid(row=2, column=0, columnspan=3, pady=10)
+        ttk.Button(dialog, text="Create library", command=confirm).grid(row=3, column=0, columnspan=3, pady=10)
+
+    def export_index(self):
+        name = self.selected_library.get()
+        if not name or name == ALL_LIBRARIES:
+            messagebox.showerror("Error", "Please select a library to export.")
+            return
+        out_path = filedialog.asksaveasfilename(title="Export library index", initialfile=f"{name}.json.gz",
+                                                defaultextension=".json.gz",
+                                                filetypes=[("Library index", "*.json.gz")])
+        if not out_path:
+            return
+        session = self.get_session()
+
+        def work(progress, cancel):
+            with closing(connect_catalog()) as conn:
+                return export_library(conn, session.library_id, session.path, out_path, cancel=cancel)
+
+        self.run_in_background("Exporting index", work,
+                               lambda count: messagebox.showinfo("Export complete",
+                                                                 f"{count} darks of '{name}' exported to\n{out_path}"))
 
     def delete_library(self):
         name = self.selected_library.get()
-        if not name:
+        if not name or name == ALL_LIBRARIES:
             messagebox.showerror("Error", "Please select a library to delete.")
             return
         confirm = messagebox.askyesno("Confirm delete", f"Really delete library '{name}'?\nThis cannot be undone! (fits remain untouched)")
         if not confirm:
             return
-        db_info = self.libraries.pop(name, None)
-        if db_info:
-            db_path = db_info["db"]
+        self.close_session()
+        if self.watcher is not None and self.watcher_name == name:
+            # Stopped first, so it cannot insert rows for the library being removed.
+            self.watcher.stop()
+            self.watcher = None
+            self.watch_text.set("")
+        info = self.libraries.pop(name, None)
+        self.invalidate_facets(name)
+        if info:
             try:
-                if os.path.exists(db_path):
-                    os.remove(db_path)
-            except Exception as e:
-                messagebox.showerror("Error", f"Could not delete database file:\n{e}")
+                with closing(connect_catalog()) as conn:
+                    remove_library(conn, info["id"])
+            except sqlite3.Error as e:
+                messagebox.showerror("Error", f"Could not delete library:\n{e}")
                 return
-            save_libraries(self.libraries)
             self.update_library_dropdown()
             self.selected_library.set("")
+            self.update_watcher()
             messagebox.showinfo("Deleted", f"Library '{name}' has been deleted.")
 
     def rescan_library(self):
         name = self.selected_library.get()
-        if not name:
+        if not name or name == ALL_LIBRARIES:
             messagebox.showerror("Error", "Please select a library to rescan.")
             return
-        db_info = self.libraries[name]
-        db_path = db_info["db"]
-        dir_path = db_info["path"]
-        fits_files = scan_directory(dir_path)
-        resp = messagebox.askyesno("Rescan results", f"Found {len(fits_files)} FITS files. Proceed with inventarisation?")
-        if not resp:
+        session = self.get_session()
+        library_id = session.library_id
+        profile = operation_profile("rescan", library=name)
+
+        def scan(progress, cancel):
+            # Walk and fingerprinting overlap, so they are timed as one phase.
+            with profile.profiled(), profile.phase("walk + fingerprints"), closing(connect_catalog()) as conn:
+                return diff_library(conn, library_id, iter_fits_files(session.path), progress=progress, cancel=cancel)
+
+        def ask(result):
+            changed, vanished, found = result
+            if not changed and not vanished:
+                messagebox.showinfo("Rescan results", f"Found {found} FITS files. Library is up to date.\n\n"
+                                                      f"{profile.finish()}")
+                return
+            resp = messagebox.askyesno("Rescan results", f"Found {found} FITS files, "
+                                                         f"{len(changed)} new or changed, {len(vanished)} removed. "
+                                                         f"Proceed with inventarisation?")
+            if not resp:
+                return
+
+            def work(progress, cancel):
+                with profile.profiled(), closing(connect_catalog()) as conn:
+                    with profile.phase("sqlite"):
+                        remove_paths(conn, library_id, changed + vanished)
+                    return ingest_files(conn, library_id, changed, progress=progress, cancel=cancel,
+                                        profile=profile)
+
+            self.run_in_background("Reading headers", work, lambda stats: done(stats, vanished, profile.finish()))
+
+        def done(stats, vanished, timings):
+            self.invalidate_facets(name)
+            if stats["cancelled"]:
+                messagebox.showinfo("Rescan cancelled", f"{stats['inserted']} darks indexed before cancelling.\n"
+                                                        f"Run Rescan again to index the remaining files.")
+            else:
+                messagebox.showinfo("Rescan complete", f"Library database updated, {len(vanished)} removed.\n"
+                                                        f"{stats['inserted']} darks indexed ({stats['duplicates']} duplicates), "
+                                                        f"{stats['skipped']} skipped ({stats['rate']:.0f} files/s).\n\n{timings}")
+            self.populate_criteria()
+
+        self.run_in_background("Scanning directory", scan, ask)
+
+    def run_in_background(self, label, work, on_done):
+        # work(progress, cancel) runs on a worker thread and must not touch Tk; its
+        # progress reports and result travel back through a queue polled with root.after.
+        if self.worker is not None:
+            messagebox.showerror("Error", "Another operation is still running.")
             return
-        with sqlite3.connect(db_path) as conn:
-            c = conn.cursor()
-            c.execute("DELETE FROM darks")
-            for f in fits_files:
-                entry = read_fits_header(f)
-                if entry:
-                    c.execute("""
-                        INSERT INTO darks (path, ccd_temp, iso, gain, exptime,
-                                           naxis1, naxis2, xbinning, ybinning)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                              (entry["path"], entry["ccd_temp"], entry["iso"],
-                               entry["gain"], entry["exptime"], entry["naxis1"],
-                               entry["naxis2"], entry["xbinning"], entry["ybinning"]))
-            conn.commit()
-        messagebox.showinfo("Rescan complete", "Library database updated.")
-        self.populate_criteria()
+        events = queue.Queue()
+        self.cancel_event = threading.Event()
+
+        def progress(done, total=None, rate=None):
+            events.put(("progress", (done, total, rate)))
+
+        def target():
+            try:
+                events.put(("done", work(progress, self.cancel_event)))
+            except Exception as e:
+                events.put(("error", e))
+
+        self.set_busy(label)
+        self.worker = threading.Thread(target=target, daemon=True)
+        self.worker.start()
+        self.root.after(100, self.poll_background, label, events, on_done)
+
+    def poll_background(self, label, events, on_done):
+        while True:
+            try:
+                kind, payload = events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "progress":
+                self.show_progress(label, *payload)
+                continue
+            self.set_idle()
+            if kind == "error":
+                if isinstance(payload, operation_cancelled):
+                    messagebox.showinfo("Cancelled", f"{label} cancelled.")
+                else:
+                    messagebox.showerror("Error", f"{label} failed:\n{payload}")
+            else:
+                on_done(payload)
+            return
+        self.root.after(100, self.poll_background, label, events, on_done)
+
+    def show_progress(self, label, done, total, rate):
+        if not total:
+            self.progress_text.set(f"{label}: {done} files" if done else f"{label}...")
+            return
+        self.progress_bar.stop()
+        self.progress_bar.config(mode="determinate", maximum=total, value=done)
+        text = f"{label}: {done}/{total} files"
+        if rate:
+            remaining = int((total - done) / rate)
+            text += f", {rate:.0f} files/s, ETA {remaining // 60}:{remaining % 60:02d}"
+        self.progress_text.set(text)
+
+    def set_busy(self, label):
+        for widget in self.busy_widgets:
+            widget.config(state="disabled")
+        self.cancel_btn.config(state="normal")
+        self.progress_text.set(f"{label}...")
+        self.progress_bar.config(mode="indeterminate", value=0)
+        self.progress_bar.start(20)
+
+    def set_idle(self):
+        self.worker = None
+        self.progress_bar.stop()
+        self.progress_bar.config(mode="determinate", value=0)
+        self.progress_text.set("")
+        self.cancel_btn.config(state="disabled")
+        for widget in self.busy_widgets:
+            widget.config(state="normal")
+        self.library_combo.config(state="readonly")
+        self.check_all_selected()
+
+    def cancel_background(self):
+        self.cancel_event.set()
+        self.cancel_btn.config(state="disabled")
+        self.progress_text.set("Cancelling...")
+
+    def get_session(self):
+        name = self.selected_library.get()
+        if self.session is None or self.session.name != name:
+            self.close_session()
+            self.session = library_session(name, self.libraries.get(name, {"id": None, "path": None}))
+        return self.session
+
+    def close_session(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    def invalidate_facets(self, name):
+        self.facets.pop(name, None)
+        self.facets.pop(ALL_LIBRARIES, None)
+
+    def get_facets(self):
+        name = self.selected_library.get()
+        if name not in self.facets:
+            session = self.get_session()
+            self.facets[name] = facet_index(session.conn, session.libraries)
+        return self.facets[name]
+
+    def current_criteria(self):
+        # The dropdowns list bucketed temperatures: a range covers its buckets completely,
+        # a single temperature is a target with the selected tolerance.
+        tmin = self.temp_var.get().strip()
+        tmax = self.temp_max_var.get().strip()
+        target = None
+        if self.temp_range_var.get() and tmin and tmax:
+            tmin, tmax = float(tmin) - TEMP_BUCKET / 2, float(tmax) + TEMP_BUCKET / 2
+        elif not self.temp_range_var.get() and tmin:
+            target = float(tmin)
+            tolerance = float(self.temp_tol_var.get().lstrip("±"))
+            tmin, tmax = target - tolerance, target + tolerance
+        else:
+            tmin = tmax = None
+        return dark_criteria(
+            tmin, tmax,
+            self.iso_var.get().strip(),
+            self.exptime_var.get().strip(),
+            self.res_var.get().strip(),
+            self.bin_var.get().strip(),
+            target,
+            self.get_session().libraries if self.selected_library.get() else None,
+        )
 
     def populate_criteria(self):
         name = self.selected_library.get()
         if not name:
             return
-        db = self.libraries[name]["db"]
-        with sqlite3.connect(db) as conn:
-            c = conn.cursor()
-            c.execute("SELECT DISTINCT ccd_temp FROM darks")
-            raw_temps = [str(r[0]) for r in c.fetchall()]
-            try:
-                temp_vals = sorted(raw_temps, key=lambda v: float(v))
-            except ValueError:
-                temp_vals = sorted(raw_temps)
-            self.temp_cb.config(values=temp_vals)
-            self.temp_max_cb.config(values=temp_vals)
-            self.temp_var.set("")
-            self.temp_max_var.set("")
+        facets = self.get_facets()
+        temp_vals = facets.temperatures()
+        self.temp_cb.config(values=temp_vals)
+        self.temp_max_cb.config(values=temp_vals)
+        self.temp_var.set("")
+        self.temp_max_var.set("")
 
-            for col, var, cb_name in [
-                ("iso", self.iso_var, "iso_cb"),
-                ("exptime", self.exptime_var, "exptime_cb"),
-                ("naxis1 || 'x' || naxis2", self.res_var, "res_cb"),
-                ("xbinning || 'x' || ybinning", self.bin_var, "bin_cb"),
-            ]:
-                c.execute(f"SELECT DISTINCT {col} FROM darks")
-                raw_values = [str(row[0]) for row in c.fetchall()]
-                try:
-                    cb_values = sorted(raw_values, key=lambda v: float(v.split("x")[0]) if "x" in v else float(v))
-                except ValueError:
-                    cb_values = sorted(raw_values)
-                getattr(self, cb_name).config(values=cb_values)
-                var.set("")
+        for field, var, cb_name in [
+            ("iso", self.iso_var, "iso_cb"),
+            ("exptime", self.exptime_var, "exptime_cb"),
+            ("resolution", self.res_var, "res_cb"),
+            ("binning", self.bin_var, "bin_cb"),
+        ]:
+            getattr(self, cb_name).config(values=facets.values(field, self.current_criteria()))
+            var.set("")
 
         self.update_matching_files()
         self.check_all_selected()
@@ -380,92 +2625,24 @@ class dark_o_mat:
         name = self.selected_library.get()
         if not name:
             return
-        db = self.libraries[name]["db"]
-        where = ""
-        params = []
-        tmin = self.temp_var.get().strip()
-        if self.temp_range_var.get():
-            tmax = self.temp_max_var.get().strip()
-            if tmin and tmax:
-                where = " WHERE ccd_temp BETWEEN ? AND ?"
-                params = [float(tmin), float(tmax)]
-        else:
-            if tmin:
-                where = " WHERE ccd_temp = ?"
-                params = [float(tmin)]
-        with sqlite3.connect(db) as conn:
-            c = conn.cursor()
-            c.execute("SELECT DISTINCT iso FROM darks" + where, params)
-            raw_iso = [str(r[0]) for r in c.fetchall()]
-            try:
-                iso_vals = sorted(raw_iso, key=lambda v: float(v))
-            except:
-                iso_vals = sorted(raw_iso)
-            self.iso_cb.config(values=iso_vals)
-            if self.iso_var.get() not in iso_vals:
-                self.iso_var.set("")
-
-            c.execute("SELECT DISTINCT exptime FROM darks" + where, params)
-            raw_exp = [str(r[0]) for r in c.fetchall()]
-            try:
-                exp_vals = sorted(raw_exp, key=lambda v: float(v))
-            except:
-                exp_vals = sorted(raw_exp)
-            self.exptime_cb.config(values=exp_vals)
-            if self.exptime_var.get() not in exp_vals:
-                self.exptime_var.set("")
-
-            c.execute("SELECT DISTINCT naxis1 || 'x' || naxis2 FROM darks" + where, params)
-            raw_res = [str(r[0]) for r in c.fetchall()]
-            try:
-                res_vals = sorted(raw_res, key=lambda v: float(v.split("x")[0]) if "x" in v else float(v))
-            except:
-                res_vals = sorted(raw_res)
-            self.res_cb.config(values=res_vals)
-            if self.res_var.get() not in res_vals:
-                self.res_var.set("")
-
-            c.execute("SELECT DISTINCT xbinning || 'x' || ybinning FROM darks" + where, params)
-            raw_bin = [str(r[0]) for r in c.fetchall()]
-            try:
-                bin_vals = sorted(raw_bin, key=lambda v: float(v.split("x")[0]) if "x" in v else float(v))
-            except:
-                bin_vals = sorted(raw_bin)
-            self.bin_cb.config(values=bin_vals)
-            if self.bin_var.get() not in bin_vals:
-                self.bin_var.set("")
+        facets = self.get_facets()
+        criteria = self.current_criteria()
+        for field, var, cb_name in [
+            ("iso", self.iso_var, "iso_cb"),
+            ("exptime", self.exptime_var, "exptime_cb"),
+            ("resolution", self.res_var, "res_cb"),
+            ("binning", self.bin_var, "bin_cb"),
+        ]:
+            values = facets.values(field, criteria)
+            getattr(self, cb_name).config(values=values)
+            if var.get() not in values:
+                var.set("")
 
     def update_matching_files(self):
         name = self.selected_library.get()
         if not name:
             return
-        db = self.libraries[name]["db"]
-        where, params = [], []
-        tmin = self.temp_var.get().strip()
-        if self.temp_range_var.get():
-            tmax = self.temp_max_var.get().strip()
-            if tmin and tmax:
-                where.append("ccd_temp BETWEEN ? AND ?")
-                params.extend([float(tmin), float(tmax)])
-        else:
-            if tmin:
-                where.append("ccd_temp = ?")
-                params.append(float(tmin))
-        for col, var in [("iso", self.iso_var),
-                         ("exptime", self.exptime_var),
-                         ("naxis1 || 'x' || naxis2", self.res_var),
-                         ("xbinning || 'x' || ybinning", self.bin_var)]:
-            val = var.get().strip()
-            if val:
-                where.append(f"{col} = ?")
-                params.append(val)
-        query = "SELECT COUNT(*) FROM darks"
-        if where:
-            query += " WHERE " + " AND ".join(where)
-        with sqlite3.connect(db) as conn:
-            c = conn.cursor()
-            c.execute(query, params)
-            count = c.fetchone()[0]
+        count = self.get_facets().count(self.current_criteria())
         self.matching_count.set(str(count))
 
         if count >= 2:
@@ -489,77 +2666,151 @@ class dark_o_mat:
         name = self.selected_library.get()
         if not name:
             return
-        db = self.libraries[name]["db"]
-        where, params = [], []
-        tmin = self.temp_var.get().strip()
-        if self.temp_range_var.get():
-            tmax = self.temp_max_var.get().strip()
-            if tmin and tmax:
-                where.append("ccd_temp BETWEEN ? AND ?")
-                params.extend([float(tmin), float(tmax)])
-        else:
-            if tmin:
-                where.append("ccd_temp = ?")
-                params.append(float(tmin))
-        for col, var in [("iso", self.iso_var),
-                         ("exptime", self.exptime_var),
-                         ("naxis1 || 'x' || naxis2", self.res_var),
-                         ("xbinning || 'x' || ybinning", self.bin_var)]:
-            val = var.get().strip()
-            if val:
-                where.append(f"{col} = ?")
-                params.append(val)
-        query = "SELECT path FROM darks"
-        if where:
-            query += " WHERE " + " AND ".join(where)
-        query += " LIMIT ?"
-        params.append(num_to_stack)
-        with sqlite3.connect(db) as conn:
-            c = conn.cursor()
-            c.execute(query, params)
-            files = [row[0] for row in c.fetchall()]
+        files = self.get_session().select_paths(self.current_criteria(), num_to_stack)
         if len(files) < 2:
             messagebox.showerror("Error", "At least 2 darks required for stacking.")
             return
 
-        tmpdir = self.target_dir.get() + "/master_dark_tmp"
-        if os.path.exists(tmpdir):
-            shutil.rmtree(tmpdir)
-        os.makedirs(tmpdir)
+        self.jobs.submit(name, self.current_criteria(), num_to_stack, self.target_dir.get())
+        self.update_jobs_view()
 
-        lib_name = re.sub(r'[^A-Za-z0-9_-]', '_', name)
-        exptime_dir = f"{self.exptime_var.get()}s"
-        outdir = os.path.join(self.target_dir.get(), lib_name, exptime_dir)
-        os.makedirs(outdir, exist_ok=True)
+    def update_watcher(self):
+        name = self.selected_library.get()
+        if self.watcher is not None and (not self.watch_var.get() or self.watcher_name != name):
+            self.watcher.stop()
+            self.watcher = None
+            self.watch_text.set("")
+        if self.watch_var.get() and name in self.libraries and self.watcher is None:
+            info = self.libraries[name]
+            self.watcher = library_watcher(info["id"], info["path"])
+            self.watcher_name = name
+            self.watch_generation = 0
+            self.watch_text.set("Watching")
 
-        for f in files:
-            shutil.copy(f, tmpdir)
+    def check_watcher(self):
+        if self.watcher is None or self.watcher.generation == self.watch_generation:
+            return
+        self.watch_generation = self.watcher.generation
+        when, indexed, removed = self.watcher.last_change
+        self.watch_text.set(f"{when:%H:%M:%S}: {indexed} indexed, {removed} removed")
+        self.invalidate_facets(self.watcher_name)
+        if self.selected_library.get() == self.watcher_name:
+            self.refresh_criteria()
 
-        master_name = self.generate_master_name()
-        master_path = os.path.join(outdir, master_name)
-        siril.cmd("cd", tmpdir)
-        siril.cmd("convert", "seq_dark")
-        siril.cmd("stack", "seq_dark", "rej", "3", "3", f"-out={master_path}")
-        siril.cmd("cd", "..")
-        shutil.rmtree(tmpdir)
-        messagebox.showinfo("Done", f"Master dark created: {master_path}")
-
-    def generate_master_name(self):
-        iso = self.iso_var.get()
-        exptime = self.exptime_var.get()
-        if self.temp_range_var.get():
-            temp = f"{self.temp_var.get()}-{self.temp_max_var.get()}"
-        else:
-            temp = self.temp_var.get()
-        binning = self.bin_var.get()
-        resolution = self.res_var.get()
-        stack_cnt = int(float(self.slider.get()))
-        current_date = datetime.today().strftime('%Y-%m-%d')
-        return f"master-dark_iso{iso}_{exptime}s_{temp}c_{resolution}_bin{binning}_{stack_cnt}x_{current_date}.fit"
+    def refresh_criteria(self):
+        # Like populate_criteria, but keeps the current selection.
+        facets = self.get_facets()
+        temp_vals = facets.temperatures()
+        self.temp_cb.config(values=temp_vals)
+        self.temp_max_cb.config(values=temp_vals)
+        self.filter_dropdowns_by_temp()
+        count = facets.count(self.current_criteria())
+        self.matching_count.set(str(count))
+        self.slider.config(to=max(2, count))
+        self.update_slider_label(None)
+        self.check_all_selected()
 
-if __name__ == "__main__":
+    def refresh_jobs(self):
+        if SIRIL_CONNECTED is not None:
+            self.siril_text.set("Siril: connected" if SIRIL_CONNECTED else "Siril: not connected, stacking with numpy")
+        self.check_watcher()
+        self.update_jobs_view()
+        self.root.after(500, self.refresh_jobs)
+
+    def update_jobs_view(self):
+        counts = self.jobs.summary()
+        active = [f"{counts[status]} {status}" for status in master_queue.ACTIVE if counts.get(status)]
+        self.jobs_text.set("Jobs: " + ", ".join(active) if active else "")
+        if self.job_tree is not None and self.job_tree.winfo_exists():
+            selected = self.job_tree.selection()
+            self.job_tree.delete(*self.job_tree.get_children())
+            with self.jobs.lock:
+                for job in self.jobs.jobs:
+                    label = os.path.basename(job["master"]) if job["master"] else job["library"]
+                    status = f"{job['status']}: {job['error']}" if job["error"] else job["status"]
+                    self.job_tree.insert("", "end", iid=str(job["id"]), values=(job["id"], label, job["frames"], status,
+                                                                                   job.get("timings") or ""))
+            self.job_tree.selection_set([iid for iid in selected if self.job_tree.exists(iid)])
+
+    def show_jobs(self):
+        if self.job_tree is not None and self.job_tree.winfo_exists():
+            self.job_tree.winfo_toplevel().lift()
+            return
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Master dark jobs")
+        self.job_tree = ttk.Treeview(dialog, columns=("id", "master", "frames", "status", "timings"),
+                                     show="headings", height=12)
+        for col, text, width in [("id", "#", 40), ("master", "Master dark", 420), ("frames", "Darks", 60),
+                                 ("status", "Status", 160), ("timings", "Timings", 320)]:
+            self.job_tree.heading(col, text=text)
+            self.job_tree.column(col, width=width, stretch=(col == "master"))
+        self.job_tree.grid(row=0, column=0, columnspan=2, sticky="nsew", padx=5, pady=5)
+        dialog.grid_columnconfigure(0, weight=1)
+        dialog.grid_rowconfigure(0, weight=1)
+
+        def cancel_selected():
+            for iid in self.job_tree.selection():
+                self.jobs.cancel(int(iid))
+
+        ttk.Button(dialog, text="Cancel selected", command=cancel_selected).grid(row=1, column=0, sticky="w", padx=5, pady=5)
+        ttk.Button(dialog, text="Clear finished", command=self.jobs.clear_finished).grid(row=1, column=1, sticky="e", padx=5, pady=5)
+        self.update_jobs_view()
+
+MODULE_LOADED = time.perf_counter()
+
+def log_startup():
+    profile = operation_profile("startup")
+    profile.add_time("imports", MODULE_LOADED - STARTED)
+    profile.add_time("window", time.perf_counter() - MODULE_LOADED)
+    profile.finish()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build master darks from a FITS dark library.")
+    parser.add_argument("--batch", dest="library", metavar="LIBRARY",
+                        help="build the full master-dark matrix of LIBRARY without opening the window; "
+                             "several comma-separated libraries or \"all\" pool their darks")
+    parser.add_argument("--target", help="target directory for the masters (batch mode)")
+    parser.add_argument("--jobs", type=int, default=BATCH_JOBS, help="number of jobs staged concurrently")
+    parser.add_argument("--max-frames", type=int, help="stack at most this many darks per master")
+    parser.add_argument("--temp-bucket", type=float, default=BATCH_TEMP_BUCKET,
+                        help="width of the temperature buckets in degrees C")
+    parser.add_argument("--backend", choices=("auto", "siril", "numpy"), default=STACK_BACKEND,
+                        help="stacking engine; auto uses Siril when connected, numpy otherwise")
+    parser.add_argument("--dry-run", action="store_true", help="only list the planned masters")
+    parser.add_argument("--watch", metavar="LIBRARY",
+                        help="keep the index of LIBRARY current while new darks are written, until interrupted")
+    parser.add_argument("--export", nargs=2, metavar=("LIBRARY", "FILE"),
+                        help="write the index of LIBRARY to FILE for use on another machine")
+    parser.add_argument("--import", dest="import_index", nargs=3, metavar=("LIBRARY", "DIRECTORY", "FILE"),
+                        help="create LIBRARY for DIRECTORY from an exported index, re-reading only changed files")
+    parser.add_argument("--duplicates", metavar="LIBRARY",
+                        help="list the darks of LIBRARY (or \"all\") that are copies of an already indexed frame")
+    args = parser.parse_args(argv)
+    if args.export:
+        return run_export(*args.export)
+    if args.import_index:
+        return run_import(*args.import_index)
+    if args.duplicates:
+        return run_duplicates(args.duplicates)
+    if args.watch:
+        return run_watch(args.watch)
+    if args.library:
+        if not args.target:
+            parser.error("--target is required in batch mode")
+        return run_batch(args)
+
+    try:
+        from ttkthemes import ThemedTk
+    except ImportError:
+        ensure_dependencies(force=True)
+        from ttkthemes import ThemedTk
     root = ThemedTk(theme="equilux")
-    root.geometry("412x516")
+    root.geometry("412x670")
     root.resizable(False, False)
-    app = dark_o_mat(root)
+    dark_o_mat(root)
+    root.after_idle(log_startup)
     root.mainloop()
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,278 @@
+"""Benchmarks for the hot paths of FITS_dark-o-mat.py.
+
+Generates synthetic dark libraries into a temporary directory and times directory
+scanning, header parsing, ingestion, the criteria queries, frame staging and master
+creation at several library sizes. Siril is replaced by a local stub, so no running
+Siril is needed; all other dependencies of the script must be installed.
+
+    python benchmarks/bench_dark_o_mat.py --sizes 1000 10000 100000 --output bench.json
+"""
+import os
+import sys
+import json
+import time
+import types
+import random
+import shutil
+import argparse
+import subprocess
+import platform
+import tempfile
+import importlib.util
+
+import numpy as np
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "FITS_dark-o-mat.py")
+
+
+def siril_stub():
+    # Stands in for sirilpy: commands are accepted and "stack ... -out=" writes a copy of
+    # the first staged frame, so the master cache sees a real output file.
+    module = types.ModuleType("sirilpy")
+
+    class SirilConnectionError(Exception):
+        pass
+
+    class SirilInterface:
+        def __init__(self):
+            self.cwd = os.getcwd()
+
+        def connect(self):
+            return True
+
+        def cmd(self, *args):
+            if args[0] == "cd":
+                self.cwd = os.path.normpath(os.path.join(self.cwd, args[1]))
+            elif args[0] == "stack":
+                out = [a[5:] for a in args if a.startswith("-out=")][0]
+                frames = sorted(f for f in os.listdir(self.cwd) if not f.startswith("seq_"))
+                shutil.copyfile(os.path.join(self.cwd, frames[0]), out)
+
+    module.SirilConnectionError = SirilConnectionError
+    module.SirilInterface = SirilInterface
+    module.ensure_installed = lambda *names: True
+    return module
+
+
+def load_dark_o_mat(home):
+    # The script keeps its registry and databases under ~, so HOME points into the
+    # benchmark directory to leave the user's libraries alone.
+    os.environ["HOME"] = home
+    sys.modules["sirilpy"] = siril_stub()
+    spec = importlib.util.spec_from_file_location("dark_o_mat", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def card(key, value):
+    if isinstance(value, bool):
+        value = "T" if value else "F"
+    elif isinstance(value, str):
+        return f"{key:<8}= '{value:<8}'".ljust(80)
+    return f"{key:<8}= {value:>20}".ljust(80)
+
+
+def fits_bytes(header, data):
+    cards = [card(k, v) for k, v in header.items()] + ["END".ljust(80)]
+    head = "".join(cards).encode("ascii")
+    head += b" " * (-len(head) % 2880)
+    body = data.astype(">i2").tobytes()
+    return head + body + b"\0" * (-len(body) % 2880)
+
+
+def generate_library(root, count, width, height, depth, fanout, seed=1):
+    # Dark frames spread over a nested tree with a realistic mix of header values, plus
+    # about 1% light frames without dark metadata and 0.1% truncated files.
+    rng = random.Random(seed)
+    noise = np.random.default_rng(seed)
+    paths = []
+    for i in range(count):
+        parts = [f"d{rng.randrange(fanout)}" for _ in range(depth)]
+        directory = os.path.join(root, *parts)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"dark_{i:07d}.fits")
+        header = {
+            "SIMPLE": True, "BITPIX": 16, "NAXIS": 2, "NAXIS1": width, "NAXIS2": height,
+            "BZERO": 32768, "BSCALE": 1,
+            "CCD-TEMP": round(rng.choice((-20.0, -10.0, 0.0)) + rng.uniform(-0.3, 0.3), 1),
+            "EXPTIME": float(rng.choice((30, 60, 120, 300))),
+            "GAIN": rng.choice((0, 100, 200)),
+            "XBINNING": rng.choice((1, 1, 2)),
+            "IMAGETYP": "Dark",
+        }
+        header["YBINNING"] = header["XBINNING"]
+        if rng.random() < 0.01:
+            del header["CCD-TEMP"]
+        data = noise.poisson(500, (height, width)).astype(np.int32) - 32768
+        content = fits_bytes(header, data)
+        if rng.random() < 0.001:
+            content = content[:1000]
+        with open(path, "wb") as f:
+            f.write(content)
+        paths.append(path)
+    return paths
+
+
+class recorder:
+    def __init__(self):
+        self.results = []
+
+    def time(self, files, phase, fn, items=None):
+        start = time.perf_counter()
+        result = fn()
+        self.add(files, phase, time.perf_counter() - start, items)
+        return result
+
+    def add(self, files, phase, seconds, items=None):
+        items = files if items is None else items
+        self.results.append({
+            "files": files,
+            "phase": phase,
+            "seconds": round(seconds, 6),
+            "items": items,
+            "per_item_us": round(seconds / items * 1e6, 3) if items else None,
+        })
+        print(f"{files:>8} files  {phase:<28} {seconds:9.3f}s", file=sys.stderr)
+
+
+def bench_startup(rec, home, runs=5):
+    # Each run imports the script in a fresh interpreter, as Siril does on every launch,
+    # then loads astropy the way the numpy stacking engine does on first use.
+    code = ("import sys, time; sys.path.insert(0, sys.argv[1]); import bench_dark_o_mat as bench; "
+            "start = time.perf_counter(); dom = bench.load_dark_o_mat(sys.argv[2]); "
+            "loaded = time.perf_counter(); dom.astropy_fits(); "
+            "print(loaded - start, time.perf_counter() - loaded, 'astropy' in sys.modules)")
+    imports, astropy = [], []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", code, os.path.dirname(os.path.abspath(__file__)), home],
+                             capture_output=True, text=True, check=True).stdout.split()
+        imports.append(float(out[-3]))
+        astropy.append(float(out[-2]))
+    for phase, samples in (("startup: import script", imports), ("startup: deferred astropy", astropy)):
+        rec.add(0, phase, min(samples), 1)
+
+
+def bench_size(dom, rec, workdir, count, args):
+    root = os.path.join(workdir, f"library_{count}")
+    rec.time(count, "generate", lambda: generate_library(root, count, args.width, args.height,
+                                                         args.depth, args.fanout))
+    files = rec.time(count, "scan_directory", lambda: dom.scan_directory(root))
+    rec.time(count, "scan (os.walk)", lambda: [os.path.join(d, f) for d, _, names in os.walk(root)
+                                               for f in names if f.lower().endswith((".fit", ".fits"))])
+    sample = files[:min(len(files), args.header_sample)]
+    rec.time(count, "read_fits_header (serial)",
+             lambda: [dom.read_fits_header(f, with_stats=False) for f in sample], len(sample))
+    rec.time(count, "read_fits_header (+stats)",
+             lambda: [dom.read_fits_header(f) for f in sample], len(sample))
+
+    db_path = os.path.join(workdir, f"library_{count}.sqlite")
+    conn = dom.connect_db(db_path)
+    library_id = dom.add_library(conn, f"library_{count}", root)
+    rec.time(count, "ingest_files", lambda: dom.ingest_files(conn, library_id, files))
+
+    rows = conn.execute(f"SELECT {dom.DARK_COLUMNS} FROM darks").fetchall()
+    insert_db = dom.connect_db(os.path.join(workdir, f"insert_{count}.sqlite"))
+
+    def insert_only():
+        for start in range(0, len(rows), dom.INSERT_BATCH_SIZE):
+            with dom.transaction(insert_db):
+                insert_db.executemany(dom.INSERT_DARK_SQL, rows[start:start + dom.INSERT_BATCH_SIZE])
+
+    rec.time(count, "insert (executemany)", insert_only, len(rows))
+    insert_db.close()
+
+    rec.time(count, "rescan diff (no changes)", lambda: dom.diff_library(conn, library_id, files))
+    rec.time(count, "rescan diff (streamed walk)", lambda: dom.diff_library(conn, library_id, dom.iter_fits_files(root)))
+    facets = rec.time(count, "facet_index build", lambda: dom.facet_index(conn))
+    combos = [dom.dark_criteria(t - 0.5, t + 0.5, iso, exp, res, binning, t)
+              for t in (-20.0, -10.0, 0.0)
+              for iso, exp, res, binning in zip(facets.columns["iso"], facets.columns["exptime"],
+                                                facets.columns["resolution"], facets.columns["binning"])][:200]
+
+    def dropdown_clicks():
+        for criteria in combos:
+            for field in dom.facet_index.FIELDS:
+                facets.values(field, criteria)
+            facets.count(criteria)
+
+    rec.time(count, "dropdown queries (facets)", dropdown_clicks, len(combos))
+
+    def sql_counts():
+        for criteria in combos:
+            where, params = dom.criteria_where(criteria)
+            conn.execute(f"SELECT COUNT(*) FROM darks{where}", params).fetchone()
+
+    rec.time(count, "match count (SQL)", sql_counts, len(combos))
+    selected = rec.time(count, "select_dark_paths", lambda: dom.select_dark_paths(conn, combos[0], args.stack), 1)
+    if len(selected) < 2:
+        selected = [row[0] for row in rows[:args.stack]]
+
+    out_dir = os.path.join(workdir, f"masters_{count}")
+    os.makedirs(out_dir, exist_ok=True)
+    for mode in ("auto", "copy"):
+        def stage(mode=mode):
+            with dom.staging_dir(out_dir) as tmpdir:
+                dom.stage_files(selected, tmpdir, mode)
+        rec.time(count, f"stage_files ({mode})", stage, len(selected))
+    rec.time(count, "master via Siril stub",
+             lambda: dom.build_master_dark(conn, selected, out_dir, os.path.join(out_dir, "stub.fit"),
+                                           backend="siril"), len(selected))
+    rec.time(count, "master via numpy",
+             lambda: dom.stack_local(selected, os.path.join(out_dir, "numpy.fit")), len(selected))
+    conn.close()
+    shutil.rmtree(root, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="library sizes (number of files) to benchmark")
+    parser.add_argument("--width", type=int, default=32, help="synthetic frame width")
+    parser.add_argument("--height", type=int, default=32, help="synthetic frame height")
+    parser.add_argument("--depth", type=int, default=3, help="directory nesting depth")
+    parser.add_argument("--fanout", type=int, default=8, help="subdirectories per level")
+    parser.add_argument("--header-sample", type=int, default=2000,
+                        help="files timed in the serial header parsing phases")
+    parser.add_argument("--stack", type=int, default=50, help="frames staged and stacked per master")
+    parser.add_argument("--workdir", help="directory for the synthetic libraries (default: a temp dir)")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="dark_o_mat_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        dom = load_dark_o_mat(os.path.join(workdir, "home"))
+        rec = recorder()
+        bench_startup(rec, os.path.join(workdir, "home"))
+        for count in args.sizes:
+            bench_size(dom, rec, workdir, count, args)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "ingest_workers": dom.INGEST_WORKERS,
+            "width": args.width,
+            "height": args.height,
+            "depth": args.depth,
+            "fanout": args.fanout,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": rec.results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())